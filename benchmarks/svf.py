@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Benchmark of the state variable filter implementations on one minute
+# of stereo sound: the numpy implementation, the Cython kernel if it is
+# built (make svf), also with one thread per channel, and the
+# per-sample Python loop, timed on a few seconds and extrapolated.
+#
+#     PYTHONPATH=.:gum python2 benchmarks/svf.py
+
+from gum.fx import svf
+import numpy
+import threading
+import time
+
+SAMPLERATE = 44100
+DURATION = 60
+
+
+def loop_svf(x, f, damping, samplerate):
+    F = 2 * numpy.sin(numpy.pi * f / samplerate)
+    Q = 2 * damping
+    yh = numpy.zeros(len(x))
+    yb = numpy.zeros(len(x))
+    yl = numpy.zeros(len(x))
+    for n in range(len(x)):
+        yh[n] = x[n] - yl[n-1] - Q * yb[n-1]
+        yb[n] = F * yh[n] + yb[n-1]
+        yl[n] = F * yb[n] + yl[n-1]
+    return yh, yb, yl
+
+
+def bench(name, function, frames, scale=1):
+    start = time.time()
+    function(frames, 500, 0.5, SAMPLERATE)
+    elapsed = (time.time() - start) * scale
+    print "%-8s %8.3fs" % (name, elapsed)
+    return elapsed
+
+
+def each_channel(function):
+    def process(frames, *args):
+        for channel in frames.transpose():
+            function(channel, *args)
+    return process
+
+
+def threaded(function):
+    # One thread per channel: the Cython kernel releases the GIL.
+    def process(frames, *args):
+        threads = [threading.Thread(target=function, args=(channel,) + args)
+                   for channel in frames.transpose()]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    return process
+
+
+if __name__ == '__main__':
+    n = SAMPLERATE * DURATION
+    frames = numpy.random.uniform(-1, 1, (n, 2))
+    print "%d s of stereo sound:" % DURATION
+    bench('numpy', svf.numpy_svf_frames, frames)
+    if svf.svf_frames is not svf.numpy_svf_frames:
+        bench('cython', svf.svf_frames, frames)
+        bench('threads', threaded(svf.svf_frames), frames)
+    else:
+        print "cython   not built"
+    seconds = 2
+    bench('loop', each_channel(loop_svf), frames[:SAMPLERATE * seconds],
+          DURATION / seconds)
@@ -6,6 +6,7 @@ from gum.lib import event
 from gum.models import Cursor, Sound, Selection, sound
 from gum.controllers import Editor, Player, effect
 from gum.views import Graph
+from gum import fx
 import os.path
 import glob
 import imp
@@ -19,7 +20,7 @@ PLUGINS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fx')
 new_sound_loaded = event.Signal()
 
 def open_(filename=None):
-    sound = Sound(filename)
+    sound = Sound(filename, background=True)
     graph = Graph(sound)
     p = Player(sound)
     curs = Cursor(graph, p)
@@ -33,12 +34,20 @@ def list_effects():
     return l
 
 def load_all_plugins():
+    # Effects listed in the manifest are imported on first use.
+    for name, module in fx.manifest.items():
+        effect.register(name, 'gum.fx.' + module)
+
+    listed = set(fx.manifest.values())
     plugins = glob.glob(os.path.join(PLUGINS_DIR, '*.py'))
 
     # The plugin may do a relative import
     sys.path.append(PLUGINS_DIR)
 
     for filename in plugins:
+        module = os.path.splitext(os.path.basename(filename))[0]
+        if module == '__init__' or module in listed:
+            continue
         try:
             execfile(filename, globals())
         except Exception, e:
@@ -48,3 +57,25 @@ def load_all_plugins():
     sys.path.remove(PLUGINS_DIR)
 
 load_all_plugins()
+
+
+# Tests
+if __name__ == '__main__':
+    import subprocess
+
+    # Importing the application without a user interface loads no GUI
+    # or audio module, and takes less than IMPORT_BUDGET seconds.
+    IMPORT_BUDGET = 0.5
+    HEAVY = ('gtk', 'gobject', 'cairo', 'alsaaudio', 'samplerate')
+    code = ("import sys, time\n"
+            "t = time.time()\n"
+            "import gum.app\n"
+            "print time.time() - t\n"
+            "print ' '.join(m for m in %r if m in sys.modules)\n" % (HEAVY,))
+    timings = []
+    for i in range(3):
+        out = subprocess.check_output([sys.executable, '-c', code])
+        elapsed, loaded = (out.split('\n') + [''])[:2]
+        assert loaded == '', loaded
+        timings.append(float(elapsed))
+    assert min(timings) < IMPORT_BUDGET, timings
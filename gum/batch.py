@@ -0,0 +1,238 @@
+# Gum sound editor (https://github.com/stackp/Gum)
+# Copyright 2009 (C) Pierre Duquesne <stackp@online.fr>
+# Licensed under the Revised BSD License.
+
+"""Apply a chain of effects to many sound files, without a user interface.
+
+Effects are given by their menu name. Effects that show a dialog take
+their slider values as arguments, and use the dialog defaults for the
+ones left out::
+
+    gum-batch -o out/ -e Normalize -e 'Filter: Low Pass(Frequency=800)' *.wav
+
+Files are processed in parallel by a pool of processes.
+
+"""
+
+from gum import app, views
+from gum.controllers import effect
+from gum.models import Sound
+from gum.lib import audiofile
+from collections import namedtuple, Counter
+import multiprocessing
+import itertools
+import traceback
+import argparse
+import time
+import sys
+import os
+import re
+
+
+Result = namedtuple('Result', 'filename output elapsed error')
+
+
+class Parameters(object):
+    """Stands for an EffectDialog: records the sliders with their
+    default values, so that the effect can be applied with given
+    values."""
+
+    def __init__(self, title=""):
+        self.title = title
+        self.parameters = {}
+
+    def add_slider(self, name, value=5, lower=0, upper=10, ndigits=0):
+        self.parameters[name] = value
+
+    def callback(self, parameters):
+        pass
+
+
+def parse_effect(spec):
+    """Parse 'Name' or 'Name(Param=value, ...)' into (name, parameters)."""
+    match = re.match(r'^(.*?)\s*(?:\((.*)\))?$', spec.strip())
+    name, args = match.groups()
+    parameters = {}
+    if args:
+        for arg in args.split(','):
+            if '=' not in arg:
+                raise ValueError("Bad effect parameter: '%s'" % arg)
+            key, value = arg.split('=', 1)
+            parameters[key.strip()] = float(value)
+    if name not in effect.effects:
+        raise ValueError("Unknown effect: '%s'" % name)
+    return name, parameters
+
+
+def apply_effect(sound, name, parameters):
+    """Apply an effect to the whole sound."""
+    result = effect.apply(name, sound, 0, sound.numframes())
+    if isinstance(result, Parameters):
+        values = dict(result.parameters)
+        for key in parameters:
+            if key not in values:
+                raise ValueError("Effect '%s' has no parameter '%s'"
+                                 % (name, key))
+        values.update(parameters)
+        result.callback(values)
+    elif parameters:
+        raise ValueError("Effect '%s' takes no parameters" % name)
+
+
+def _init():
+    # Effects that ask for parameters get a Parameters object.
+    views.dialog_class = Parameters
+
+
+def output_path(filename, outdir):
+    """Return the path where the processed filename is written."""
+    return os.path.join(outdir, os.path.basename(filename))
+
+
+def process(job):
+    """Apply a chain of effects to a file. Return a Result."""
+    filename, chain, output, dtype = job
+    start = time.time()
+    try:
+        sound = Sound(filename, dtype)
+        for name, parameters in chain:
+            apply_effect(sound, name, parameters)
+        sound.save_as(output)
+    except Exception:
+        error = traceback.format_exc().strip().split('\n')[-1]
+        return Result(filename, None, time.time() - start, error)
+    return Result(filename, output, time.time() - start, None)
+
+
+def run(filenames, chain, outdir, dtype='float64', jobs=None, report=None):
+    """Process files in a pool of jobs processes and return the Results,
+    in completion order. report is called with each Result.
+
+    Files that would be written to the same output, such as files with
+    the same name in different directories, are not processed: they
+    are reported as failures first.
+
+    """
+    outputs = [output_path(filename, outdir) for filename in filenames]
+    count = Counter(os.path.normcase(os.path.abspath(output))
+                    for output in outputs)
+    tasks = []
+    collisions = []
+    for filename, output in zip(filenames, outputs):
+        if count[os.path.normcase(os.path.abspath(output))] > 1:
+            error = "Output file '%s' is shared with another file" % output
+            collisions.append(Result(filename, None, 0., error))
+        else:
+            tasks.append((filename, chain, output, dtype))
+    if jobs == 1:
+        _init()
+        results = (process(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, initializer=_init)
+        results = pool.imap_unordered(process, tasks)
+    done = []
+    try:
+        for result in itertools.chain(collisions, results):
+            done.append(result)
+            if report is not None:
+                report(result)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return done
+
+
+def _print_result(result):
+    if result.error is None:
+        print "ok    %7.2fs  %s -> %s" % (result.elapsed, result.filename,
+                                          result.output)
+    else:
+        print "FAIL  %7.2fs  %s: %s" % (result.elapsed, result.filename,
+                                        result.error)
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Apply effects to sound files.",
+        epilog="Effects: " + ", ".join(sorted(app.list_effects())))
+    parser.add_argument('files', nargs='+', metavar='FILE')
+    parser.add_argument('-e', '--effect', action='append', required=True,
+                        help="effect to apply, as 'Name' or "
+                             "'Name(Param=value, ...)'; may be repeated")
+    parser.add_argument('-o', '--output', required=True, metavar='DIR',
+                        help="directory where processed files are written")
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help="number of processes (default: one per CPU)")
+    parser.add_argument('--dtype', choices=audiofile.DTYPES,
+                        default='float64', help="sample storage mode")
+    args = parser.parse_args(argv)
+
+    try:
+        chain = [parse_effect(spec) for spec in args.effect]
+    except ValueError, e:
+        parser.error(str(e))
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    start = time.time()
+    results = run(args.files, chain, args.output, args.dtype, args.jobs,
+                  _print_result)
+    failed = [r for r in results if r.error is not None]
+    print "%d files processed, %d failed, in %.2fs" % (
+        len(results), len(failed), time.time() - start)
+    return 1 if failed else 0
+
+
+# Tests
+if __name__ == '__main__':
+    import gum
+    import shutil
+    import tempfile
+
+    _init()
+    assert parse_effect('Normalize') == ('Normalize', {})
+    assert parse_effect('Filter: Low Pass(Frequency=800, Damping=1)') == \
+        ('Filter: Low Pass', {'Frequency': 800., 'Damping': 1.})
+    for spec in ['Nothing', 'Volume(50)']:
+        try:
+            parse_effect(spec)
+        except ValueError:
+            pass
+        else:
+            assert False
+
+    # The chain is applied to each file; failures are reported.
+    outdir = tempfile.mkdtemp()
+    infile = os.path.join(gum.testdir, 'test1.wav')
+    chain = [parse_effect('Volume(Volume=50)'), parse_effect('Reverse')]
+    results = run([infile, '/nonexistent.wav'], chain, outdir, jobs=2)
+    assert len(results) == 2
+    results = dict((r.filename, r) for r in results)
+    assert results['/nonexistent.wav'].error is not None
+    ok = results[infile]
+    assert ok.error is None and ok.elapsed >= 0
+    x = Sound(infile).frames
+    y = Sound(ok.output).frames
+    assert abs(y - x[::-1] * 0.5).max() < 1e-4
+
+    # Files that would overwrite each other are not processed.
+    indir = tempfile.mkdtemp()
+    other = os.path.join(indir, 'test1.wav')
+    shutil.copy(infile, other)
+    results = run([infile, other], chain, outdir + '/same', jobs=1)
+    assert sorted(r.filename for r in results if r.error is not None) == \
+           sorted([infile, other])
+    assert not os.path.exists(outdir + '/same')
+    shutil.rmtree(indir)
+
+    # Dialog parameters are checked.
+    try:
+        apply_effect(Sound(infile), 'Volume', {'Gain': 1})
+    except ValueError:
+        pass
+    else:
+        assert False
+    shutil.rmtree(outdir)
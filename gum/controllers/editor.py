@@ -6,9 +6,15 @@ from gum.models import Sound, clipboard, sound
 from player import Player
 import effect
 from gum.lib.event import Signal
-from gum.lib import edit
+from gum.lib import edit, audiofile
+import functools
+import threading
 import traceback
 
+# Effects are previewed over at most this many seconds from the start
+# of the selection.
+PREVIEW_LENGTH = 3
+
 class Editor(object):
 
     def __init__(self, sound, player, graph, selection):
@@ -16,8 +22,14 @@ class Editor(object):
         self._graph = graph
         self._selection = selection
         self._sound = sound
+        self._writers = []
+        self._writers_lock = threading.Lock()
         self.filename_changed = Signal()
         self.error = Signal()
+        # Called with the fraction of the file written while saving in
+        # the background, and with 1.0 when done. Like filename_changed
+        # and error, it may be called from a writer thread.
+        self.save_progress = Signal()
 
     def new(self):
         import gum.app
@@ -54,20 +66,36 @@ class Editor(object):
     @_report_exception
     def load_sound(self, filename):
         self._player.stop()
-        self._sound = Sound(filename)
+        self._sound = Sound(filename, background=True)
         self._graph.set_sound(self._sound)
         self._player.set_sound(self._sound)
         self._selection.unselect()
         self.filename_changed()
 
+    def _save(self, sound, filename, on_success=None):
+        """Save sound in the background."""
+        def finished(error):
+            with self._writers_lock:
+                self._writers.remove(writer)
+            self.save_progress(1.0)
+            if error is None:
+                if on_success is not None:
+                    on_success()
+            elif not isinstance(error, audiofile.Cancelled):
+                self.error("Error", str(error))
+        with self._writers_lock:
+            writer = sound.save_as(filename, background=True,
+                                   callback=finished,
+                                   progress=self.save_progress)
+            self._writers.append(writer)
+
     @_report_exception
     def save(self):
-        self._sound.save()
+        self._save(self._sound, self._sound.filename)
 
     @_report_exception
     def save_as(self, filename):
-        self._sound.save_as(filename)
-        self.filename_changed()
+        self._save(self._sound, filename, self.filename_changed)
 
     @_report_exception
     def save_selection_as(self, filename):
@@ -77,18 +105,24 @@ class Editor(object):
         start, end = self._selection.get()
         sound.frames = self._sound.copy(start, end)
         sound.samplerate = self._sound.samplerate
-        sound.save_as(filename)
+        self._save(sound, filename)
+
+    def cancel_save(self):
+        with self._writers_lock:
+            for writer in self._writers:
+                writer.cancel()
 
     def close(self, force=False):
         sound = self._sound
         if not sound.is_saved() and not sound.is_fresh() and not force:
             raise FileNotSaved
         self._player.stop()
+        sound.close()
 
     def play(self):
         start, end = self._selection.get()
         if not self._selection.selected():
-            end = len(self._sound.frames)
+            end = self._sound.numframes()
         self._player.start = start
         self._player.end = end
         self._player.thread_play()
@@ -107,7 +141,7 @@ class Editor(object):
         self._graph.move_to(0)
 
     def goto_end(self):
-        end = len(self._sound.frames)
+        end = self._sound.numframes()
         self._selection.set(end, end)
         self._graph.move_to(end)
 
@@ -160,7 +194,7 @@ class Editor(object):
 
     def fix_selection(self):
         start, end = self._selection.get()
-        n = len(self._sound.frames)
+        n = self._sound.numframes()
         if end > n:
             # Selection has become invalid.
             start = min(start, n)
@@ -180,9 +214,25 @@ class Editor(object):
             start, end = self._selection.get()
         else:
             start = 0
-            end = len(self._sound.frames)
-        fx = effect.effects[name]
-        return fx(self._sound, start, end)
+            end = self._sound.numframes()
+        dialog = effect.apply(name, self._sound, start, end)
+        if dialog is not None:
+            dialog.preview = functools.partial(self.preview, start, end)
+        return dialog
+
+    def preview(self, start, end, processor):
+        """Play the beginning of the range from start to end in a loop
+        through processor, or stop if processor is None. Nothing is
+        written to the sound."""
+        if processor is None:
+            self._player.stop()
+        elif self._player.is_playing() and self._player.processor:
+            self._player.processor = processor
+        else:
+            length = int(PREVIEW_LENGTH * self._sound.samplerate)
+            self._player.start = start
+            self._player.end = min(end, start + length)
+            self._player.thread_preview(processor)
 
     def filename(self):
         return self._sound.filename
@@ -254,6 +304,54 @@ def test_fix_selection():
     assert sound.frames.tolist() == frames.tolist()
     
 
+def test_preview():
+    from gum.lib.mock import Fake
+    import numpy
+
+    class Player(object):
+        def __init__(self):
+            self.playing = False
+            self.processor = None
+        def thread_preview(self, processor):
+            self.playing = True
+            self.processor = processor
+        def is_playing(self):
+            return self.playing
+        def stop(self):
+            self.playing = False
+
+    class Dialog(object):
+        def callback(self, parameters):
+            pass
+
+    def fx(sound, start, end):
+        d = Dialog()
+        d.processor = lambda parameters: effect.Map(lambda x: x * 2)
+        return d
+
+    effect.effects['Test Preview'] = fx
+    sound = Sound()
+    sound.frames = numpy.zeros(10 * sound.samplerate)
+    player = Player()
+    editor = Editor(sound, player, Fake(), Fake())
+    editor._selection.get = lambda: (100, 9 * sound.samplerate)
+    editor._selection.selected = lambda: True
+    d = editor.effect('Test Preview')
+    first = d.processor({})
+    d.preview(first)
+    assert player.processor is first
+    assert (player.start, player.end) == \
+           (100, 100 + PREVIEW_LENGTH * sound.samplerate)
+    second = d.processor({})
+    d.preview(second)
+    assert player.processor is second
+    d.preview(None)
+    assert not player.is_playing()
+    assert sound.frames.tolist() == [0] * len(sound.frames)
+    del effect.effects['Test Preview']
+
+
 if __name__ == "__main__":
     test_Editor()
     test_fix_selection()
+    test_preview()
@@ -1,8 +1,185 @@
+from gum.lib import edit, pieces, parallel
 import numpy
 from copy import copy
+from collections import namedtuple
+import importlib
+import time
 
+# Maps a menu name to a function called with (sound, start, end).
 effects = {}
 
+# Maps a menu name to the Timing of the runs of the effect.
+timings = {}
+
+Timing = namedtuple('Timing', 'runs frames seconds')
+
+
+class LazyEffect(object):
+    """An effect whose module is imported when it is first invoked.
+
+    Importing the module must register the effect under the same
+    name, which replaces the LazyEffect.
+
+    """
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+
+    def load(self):
+        importlib.import_module(self.module)
+        fx = effects.get(self.name)
+        if fx is None or fx is self:
+            raise Exception("Plugin '%s' does not provide effect '%s'"
+                            % (self.module, self.name))
+        return fx
+
+    def __call__(self, sound, start, end):
+        return self.load()(sound, start, end)
+
+
+def register(name, module):
+    """Declare that importing module registers the effect name."""
+    if name not in effects:
+        effects[name] = LazyEffect(name, module)
+
+
+def _record(name, frames, seconds):
+    runs, total_frames, total_seconds = timings.get(name, (0, 0, 0.))
+    timings[name] = Timing(runs + 1, total_frames + frames,
+                           total_seconds + seconds)
+
+
+def _timed(name, frames, function):
+    def timed(*args):
+        t = time.time()
+        try:
+            return function(*args)
+        finally:
+            _record(name, frames, time.time() - t)
+    return timed
+
+
+def apply(name, sound, start, end):
+    """Apply the effect name to the frames from start to end, and
+    return its dialog if it has one. The time spent applying it is
+    added to timings, when the dialog callback is called if there is a
+    dialog."""
+    fx = effects[name]
+    t = time.time()
+    dialog = fx(sound, start, end)
+    if dialog is None:
+        _record(name, end - start, time.time() - t)
+    else:
+        dialog.callback = _timed(name, end - start, dialog.callback)
+    return dialog
+
+
+# Streaming effects process the selection block by block, so that
+# they only hold a few blocks of frames besides their output.
+BLOCKSIZE = 65536
+
+
+class Processor(object):
+    """Process frames block by block.
+
+    process() is called with successive blocks of frames and returns
+    the output for each block, carrying any state to the next one.
+    flush() returns the output left once all blocks are processed, or
+    None.
+
+    framewise is True for processors that process each frame on its
+    own, and preserves_length for those that return as many frames as
+    they are given: in non-destructive mode, the output of the latter
+    is rendered when it is read.
+
+    """
+
+    framewise = False
+    preserves_length = False
+
+    def process(self, block):
+        return block
+
+    def flush(self):
+        return None
+
+
+class Map(Processor):
+    """Apply a function that processes each frame independently.
+    Large blocks are cut in chunks that are processed in parallel."""
+
+    framewise = True
+    preserves_length = True
+
+    def __init__(self, function):
+        self._function = function
+
+    def process(self, block):
+        return parallel.map_frames(self._function, block)
+
+
+class Fade(Processor):
+    """Linear fade in or out over length frames."""
+
+    preserves_length = True
+
+    def __init__(self, length, type='in'):
+        self._length = length
+        self._type = type
+        self._position = 0
+
+    def process(self, block):
+        n = len(block)
+        curve = numpy.arange(self._position, self._position + n,
+                             dtype='float64')
+        curve /= max(self._length - 1, 1)
+        self._position += n
+        if self._type == 'out':
+            curve = 1 - curve
+        if block.ndim > 1:
+            curve = curve[:, numpy.newaxis]
+        return block * curve
+
+
+def render(sound, start, end, processor, blocksize=None):
+    """Yield the output blocks of processor over the frames from start
+    to end."""
+    if blocksize is None:
+        blocksize = BLOCKSIZE
+    for i in range(start, end, blocksize):
+        block = processor.process(sound.read(i, min(i + blocksize, end)))
+        if block is not None and len(block):
+            yield block
+    block = processor.flush()
+    if block is not None and len(block):
+        yield block
+
+
+def paste_blocks(sound, start, end, blocks):
+    """Replace the frames from start to end with blocks, in one history
+    step. Blocks are stored as they are: they must not be modified
+    afterwards."""
+    numchan = sound.numchan()
+    empty = sound.is_empty()
+    clip = []
+    for block in blocks:
+        if not empty and block.ndim != numchan:
+            block = edit.mix_channels_auto(block, numchan)
+        clip.append(sound.compact(block))
+    sound.paste(start, end, pieces.Pieces.join(clip))
+
+
+def stream(sound, start, end, processor, blocksize=None):
+    """Replace the frames from start to end with the output of
+    processor."""
+    if sound.nondestructive and processor.preserves_length:
+        sound.apply(start, end, processor)
+        return
+    blocks = render(sound, start, end, processor, blocksize)
+    paste_blocks(sound, start, end, blocks)
+
+
 def reverse(x):
     return numpy.flipud(x)
 
@@ -19,33 +196,54 @@ def negate(x):
     return -x
 
 def fade(x, type='in'):
-    N = len(x)
-    curve = numpy.array(range(N)) / float(N - 1)
-    if type == 'out':
-        curve = reverse(curve)
-    if x.ndim > 1:
-        curve = [curve] * x.ndim
-        curve = numpy.array(curve)
-        curve = curve.transpose()
-    y = copy(x) * curve
-    return y
+    return Fade(len(x), type).process(x)
 
 def fade_out(x):
     return fade(x, 'out')
 
 def mkfx_overwrite_selection(function):
     def process(sound, start, end):
-        x = sound.frames[start:end]
+        x = sound.read(start, end)
         y = function(x)
         sound.paste(start, end, y)
     return process
 
+def mkfx_transform(function, inverse, framewise=False):
+    def process(sound, start, end):
+        sound.transform(start, end, function, inverse, framewise)
+    return process
+
+def gain(g):
+    """Return a function that multiplies frames by g."""
+    def process(x):
+        return parallel.map_frames(lambda x: x * g, x)
+    return process
+
+def transform_gain(sound, start, end, g):
+    """Multiply the frames from start to end by g. The history only
+    keeps the gain when it is a power of two, which is undone exactly
+    by its inverse; other gains are streamed."""
+    if g != 0 and abs(numpy.frexp(g)[0]) == 0.5:
+        sound.transform(start, end, gain(g), gain(1. / g), framewise=True)
+    else:
+        stream(sound, start, end, Map(lambda x: x * g))
+
+def normalize_fx(sound, start, end):
+    x = sound.read(start, end)
+    M = abs(x).max() if len(x) else 0
+    transform_gain(sound, start, end, 1. / M if M != 0 else 1)
+
+def mkfx_fade(type):
+    def process(sound, start, end):
+        stream(sound, start, end, Fade(end - start, type))
+    return process
+
 # Register effects
-effects['Reverse'] = mkfx_overwrite_selection(reverse)
-effects['Normalize'] = mkfx_overwrite_selection(normalize)
-effects['Negate'] = mkfx_overwrite_selection(negate)
-effects['Fade In'] = mkfx_overwrite_selection(fade)
-effects['Fade Out'] = mkfx_overwrite_selection(fade_out)
+effects['Reverse'] = mkfx_transform(reverse, reverse)
+effects['Normalize'] = normalize_fx
+effects['Negate'] = mkfx_transform(negate, negate, framewise=True)
+effects['Fade In'] = mkfx_fade('in')
+effects['Fade Out'] = mkfx_fade('out')
 
 # Tests
 if __name__ == '__main__':
@@ -67,6 +265,27 @@ if __name__ == '__main__':
     assert snd.frames.tolist() == [[0, 0], [1, 1], [2, 2], [5, 5],
                                   [4, 4], [3, 3], [6, 6], [7, 7]]
 
+    # reverse and negate are undone without keeping frames.
+    fx(snd, 0, 8)
+    effects['Negate'](snd, 2, 5)
+    assert snd.history.memory_usage() == (0, 0)
+    snd.undo()
+    snd.undo()
+    assert snd.frames.tolist() == [[0, 0], [1, 1], [2, 2], [5, 5],
+                                  [4, 4], [3, 3], [6, 6], [7, 7]]
+
+    # gains are only undone by their inverse when it is exact.
+    snd = Sound()
+    x = numpy.random.uniform(-1, 1, 1000)
+    snd.frames = x
+    transform_gain(snd, 0, 1000, 4)
+    assert snd.history.memory_usage() == (0, 0)
+    transform_gain(snd, 0, 1000, 0.3)
+    assert snd.history.memory_usage()[0] > 0
+    snd.undo()
+    snd.undo()
+    assert (snd.frames == x).all()
+
     # test normalize
     fx = effects['Normalize']
 
@@ -113,3 +332,88 @@ if __name__ == '__main__':
     snd.frames = numpy.array([1, 1, 1])
     fx(snd, 0, 3)
     assert snd.frames.tolist() == [1, 0.5, 0]
+
+    # test streaming: the output does not depend on the block size.
+    x = numpy.random.uniform(-1, 1, (1000, 2))
+    snd = Sound()
+    snd.frames = x
+    stream(snd, 100, 900, Fade(800), blocksize=64)
+    assert len(snd._pieces.spans()) > 3
+    y = snd.frames
+    snd.undo()
+    assert (snd.frames == x).all()
+    stream(snd, 100, 900, Fade(800), blocksize=10000)
+    assert numpy.allclose(snd.frames, y)
+    assert numpy.allclose(y[100:900], fade(x[100:900]))
+    assert (y[:100] == x[:100]).all() and (y[900:] == x[900:]).all()
+
+    # a processor may output more frames than it is given.
+    class Echo(Processor):
+        def process(self, block):
+            return block
+        def flush(self):
+            return numpy.array([1., 1.])
+    snd.frames = numpy.zeros(10)
+    stream(snd, 0, 10, Echo(), blocksize=3)
+    assert snd.frames.tolist() == [0] * 10 + [1, 1]
+
+    # in non-destructive mode, the output is rendered when read.
+    snd = Sound(nondestructive=True)
+    snd.frames = numpy.arange(1000.)
+    stream(snd, 100, 900, Fade(800))
+    buffer = snd._pieces.spans()[1][0]
+    assert not isinstance(buffer, numpy.ndarray)
+    assert numpy.allclose(snd.frames[100:900], fade(numpy.arange(100., 900.)))
+    stream(snd, 0, 10, Echo())
+    assert len(snd.frames) == 1002
+
+    # blocks are converted to the storage mode of the sound.
+    snd = Sound(dtype='float32')
+    snd.frames = numpy.ones(10, dtype='float32')
+    stream(snd, 0, 10, Map(lambda x: x * 2.))
+    assert snd.frames.dtype == numpy.float32
+    assert snd.frames.tolist() == [2] * 10
+
+    # test lazy effects: the plugin is imported on first use.
+    import sys, tempfile, shutil
+    import gum.controllers
+    gum.controllers.effect = sys.modules[__name__]
+    plugindir = tempfile.mkdtemp()
+    with open(plugindir + '/lazyfx.py', 'w') as f:
+        f.write("from gum.controllers import effect\n"
+                "effect.effects['Lazy Reverse'] = "
+                "effect.mkfx_overwrite_selection(effect.reverse)\n")
+    sys.path.append(plugindir)
+    register('Lazy Reverse', 'lazyfx')
+    register('Missing', 'lazyfx')
+    assert 'lazyfx' not in sys.modules
+    assert isinstance(effects['Lazy Reverse'], LazyEffect)
+    fx = effects['Lazy Reverse']
+    snd = Sound()
+    snd.frames = numpy.array([1, 2, 3])
+    fx(snd, 0, 3)
+    assert snd.frames.tolist() == [3, 2, 1]
+    assert 'lazyfx' in sys.modules
+    assert not isinstance(effects['Lazy Reverse'], LazyEffect)
+    try:
+        effects['Missing'](snd, 0, 3)
+    except Exception:
+        pass
+    else:
+        assert False
+    sys.path.remove(plugindir)
+    shutil.rmtree(plugindir)
+
+    # timings are recorded when the effect is applied, after its dialog.
+    class Dialog(object):
+        def callback(self, parameters):
+            stream(snd, 0, 3, Map(lambda x: x * parameters['Gain']))
+    effects['Gain'] = lambda sound, start, end: Dialog()
+    d = apply('Gain', snd, 0, 3)
+    assert 'Gain' not in timings
+    d.callback({'Gain': 2})
+    assert snd.frames.tolist() == [6, 4, 2]
+    apply('Reverse', snd, 1, 3)
+    assert timings['Gain'].runs == 1 and timings['Gain'].frames == 3
+    assert timings['Reverse'] == (1, 2, timings['Reverse'].seconds)
+    del effects['Gain']
@@ -2,13 +2,13 @@
 # Copyright 2009 (C) Pierre Duquesne <stackp@online.fr>
 # Licensed under the Revised BSD License.
 
-import alsaaudio
 import threading
 from  gum.lib.event import Signal
 import numpy
 
 class AlsaBackend(object):
     def __init__(self, rate=44100):
+        import alsaaudio
         self._pcm = alsaaudio.PCM(type=alsaaudio.PCM_PLAYBACK,
                             mode=alsaaudio.PCM_NORMAL)
         self._pcm.setchannels(2)
@@ -44,32 +44,51 @@ class Player(object):
         self.start_playing = Signal()
         self.stop_playing = Signal()
         self.position = 0
-        self._backend = AlsaBackend()
+        # When previewing, frames go through this effect.Processor and
+        # the range is played in a loop.
+        self.processor = None
+        self._loop = False
+        # The audio device is opened on first use.
+        self._backend = None
         self.set_sound(sound)
 
     def set_sound(self, sound):
         self._sound = sound
         self.start = 0
-        self.end = len(sound.frames)
+        self.end = sound.numframes()
         self.set_samplerate(self._sound.samplerate)
 
     def set_samplerate(self, rate):
-        self._backend.set_samplerate(rate)
+        self._samplerate = rate
+        if self._backend is not None:
+            self._backend.set_samplerate(rate)
+
+    def _get_backend(self):
+        if self._backend is None:
+            self._backend = AlsaBackend(self._samplerate)
+        return self._backend
 
     def play(self):
         self.position = self.start
         self.start_playing()
         try:
+            backend = self._get_backend()
             while self._playing:
+                if self.position >= self.end and self._loop:
+                    self.position = self.start
                 if self.position >= self.end:
                     self._playing = False
                 else:
                     start = self.position
-                    end = min(self.position + self._backend.periodsize, 
+                    end = min(self.position + backend.periodsize, 
                               self.end)
-                    buf = self._sound.frames[start:end]
+                    buf = self._sound.read(start, end)
                     self.position = end
-                    self._backend.write(buf)
+                    processor = self.processor
+                    if processor is not None:
+                        buf = processor.process(buf)
+                    if buf is not None:
+                        backend.write(buf)
         finally:
             self.stop_playing()
             self._lock.release()
@@ -79,6 +98,21 @@ class Player(object):
         # playing, stop it before creating a new thread.
         self._playing = False
         self._lock.acquire()
+        self._loop = False
+        self.processor = None
+        self._playing = True
+        t = threading.Thread(target=self.play, args=())
+        t.start()
+        return t
+
+    def thread_preview(self, processor):
+        """Play from start to end in a loop through processor, until
+        stop() is called. The processor attribute can be replaced while
+        previewing; it takes effect from the next period."""
+        self._playing = False
+        self._lock.acquire()
+        self._loop = True
+        self.processor = processor
         self._playing = True
         t = threading.Thread(target=self.play, args=())
         t.start()
@@ -92,15 +126,51 @@ class Player(object):
 
 
 # test
+def testPreview():
+    from gum.models import Sound
+    from gum.controllers import effect
+    import time
+
+    class Backend(object):
+        periodsize = 4
+        def __init__(self):
+            self.written = []
+        def write(self, buf):
+            self.written.append(buf)
+            time.sleep(0.001)
+
+    sound = Sound()
+    sound.frames = numpy.arange(10.)
+    player = Player(sound)
+    player._backend = backend = Backend()
+    player.start = 2
+    player.end = 8
+    player.thread_preview(effect.Map(lambda x: -x))
+    while len(backend.written) < 5:
+        time.sleep(0.001)
+    player.processor = effect.Map(lambda x: x * 10)
+    while len(backend.written) < 12:
+        time.sleep(0.001)
+    player.stop()
+    while player.is_playing():
+        time.sleep(0.001)
+    y = numpy.concatenate(backend.written).tolist()
+    assert y[:6] == [-2, -3, -4, -5, -6, -7]
+    assert set(y[-6:]) <= set(range(20, 80, 10))
+
+    # Playing again does not loop nor process.
+    backend.written = []
+    player.thread_play().join()
+    assert numpy.concatenate(backend.written).tolist() == range(2, 8)
+
 def testPlayer():
-    from gum.lib.mock import Mock
+    from gum.models import Sound
     from math import sin
     SR = 44100
     f0 = 440
     time = 1
     sine = numpy.array([sin(2 * 3.14 * f0/SR * x) for x in range(time * SR)])
-    sound = Mock({"numchan": 1})
-    sound.samplerate = 44100
+    sound = Sound()
     sound.frames = sine
     
     player = Player(sound)
@@ -150,12 +220,12 @@ def testPlayer():
     # Testing stereo
     f = pysndfile.PySndfile(gum.basedir + '/data/test/test2.wav')
     data = f.read_frames(f.frames())
-    sound = Mock({"numchan": 2})
-    sound.samplerate = 44100
+    sound = Sound()
     sound.frames = data
     player = Player(sound)
     player.thread_play().join()
 
 if __name__ == '__main__':
+    testPreview()
     testPlayer()
     print "done"
@@ -1,42 +1,99 @@
-from collections import namedtuple
+# The overview of a sound is made of cells, one per pixel column,
+# holding the min, max, mean and standard deviation of the frames it
+# covers. Cells are arrays of shape (channels, cells, 4), indexed by
+# MIN, MAX, MEAN and STD in the last dimension.
 
-Cell = namedtuple('Cell', 'min max mean std')
+import numpy
+import threading
+import peaks
 
 
-def _condense(data, start, width, density):
+def _round(x):
+    # Python 2 round(): halves are rounded away from zero.
+    return numpy.sign(x) * numpy.floor(numpy.abs(x) + 0.5)
+
+
+MIN, MAX, MEAN, STD = range(4)
+
+
+def _reduce(values, a, b):
+    """Merge the cells of values from a[i] to b[i] into cell i, for
+    each i. values has the shape (channels, cells, 4), and cells in
+    each range must not be empty."""
+    # Only the cells in the ranges are read.
+    lo, hi = a[0], b[-1]
+    values = values[:, lo:hi]
+    a, b = a - lo, b - lo
+    # Each range is reduced by reduceat() over the pairs of indices
+    # (a, b); the results for (b, next a) are dropped. A padding cell
+    # keeps the indices in range when a range ends with the data.
+    indices = numpy.empty(2 * len(a), dtype=numpy.intp)
+    indices[0::2] = a
+    indices[1::2] = b
+    padded = numpy.concatenate((values, values[:, -1:]), axis=1)
+    out = numpy.empty((len(values), len(a), 4), dtype=values.dtype)
+    n = (b - a).astype(numpy.float64)
+    means = padded[:, :, MEAN].astype(numpy.float64)
+    stds = padded[:, :, STD].astype(numpy.float64)
+    out[:, :, MIN] = numpy.minimum.reduceat(padded[:, :, MIN], indices,
+                                            axis=1)[:, 0::2]
+    out[:, :, MAX] = numpy.maximum.reduceat(padded[:, :, MAX], indices,
+                                            axis=1)[:, 0::2]
+    mean = numpy.add.reduceat(means, indices, axis=1)[:, 0::2] / n
+    squares = numpy.add.reduceat(stds * stds + means * means, indices,
+                                 axis=1)[:, 0::2] / n
+    out[:, :, MEAN] = mean
+    out[:, :, STD] = numpy.sqrt(numpy.maximum(squares - mean * mean, 0))
+    return out
+
+
+def _condense(data, start, width, density, offset, dlen):
     """
     Scale the data by the density factor and slice it into cells. Compute
-    the statistical properties of each cell. Return a list of cell values.
+    the statistical properties of each cell. Return an array of shape
+    (channels, cells, 4). data holds the frames of the sound from offset
+    on, one column per channel if it has several; dlen is the length of
+    the sound.
     """
-    res = []
-    start = int(start)
-    width = int(width)
-    dlen = len(data)
-    for i in range(start, start + width):
-        a = int(round((i - 0.25) * density))
-        b = int(round((i + 1.25) * density))
-        if a < 0: a = 0
-        if a >= dlen: break
-        if b > dlen: b = dlen
-        d = data[a:b]
-        mini = d.min()
-        maxi = d.max()
-        mean = d.mean() if dlen >= 2 else mini
-        std = d.std() if dlen > 2 else 0
-        res.append(Cell(mini, maxi, mean, std))
-    return res
-
-
-def _merge_cells(vals):
-    o_min, o_max, o_mean, o_std = 1, -1, 0, 0
-    for v in vals:
-        o_min = min(v.min, o_min)
-        o_max = max(v.max, o_max)
-        o_mean += v.mean
-        o_std += v.std
-    o_mean /= len(vals)
-    o_std /= len(vals)
-    return Cell(o_min, o_max, o_mean, o_std)
+    # Cells overlap: cell i covers frames (i - 0.25) * density to
+    # (i + 1.25) * density.
+    i = numpy.arange(start, start + width, dtype=numpy.float64)
+    a = _round((i - 0.25) * density).astype(numpy.intp)
+    b = _round((i + 1.25) * density).astype(numpy.intp)
+    numpy.maximum(a, 0, out=a)
+    keep = a < dlen
+    a, b = a[keep], numpy.minimum(b[keep], dlen)
+    return _windows(data, a, b, offset, dlen)
+
+
+def _windows(data, a, b, offset, dlen):
+    """Return an array of shape (channels, len(a), 4) holding the cells
+    for the frames from a[i] to b[i], which must not be empty. data
+    and dlen are as in _condense()."""
+    if data.ndim == 1:
+        data = data[:, numpy.newaxis]
+    if not len(a):
+        return numpy.zeros((data.shape[1], 0, 4))
+
+    # As in _reduce(), with frames instead of cells.
+    indices = numpy.empty(2 * len(a), dtype=numpy.intp)
+    indices[0::2] = a - offset
+    indices[1::2] = b - offset
+    padded = numpy.concatenate((data, data[-1:]))
+    out = numpy.empty((data.shape[1], len(a), 4))
+    out[:, :, MIN] = numpy.minimum.reduceat(padded, indices)[0::2].T
+    out[:, :, MAX] = numpy.maximum.reduceat(padded, indices)[0::2].T
+    n = (b - a)[:, numpy.newaxis].astype(numpy.float64)
+    padded = padded.astype(numpy.float64)
+    means = numpy.add.reduceat(padded, indices)[0::2] / n
+    squares = numpy.add.reduceat(padded * padded, indices)[0::2] / n
+    out[:, :, MEAN] = means.T
+    out[:, :, STD] = numpy.sqrt(numpy.maximum(squares - means * means, 0)).T
+    if dlen < 2:
+        out[:, :, MEAN] = out[:, :, MIN]
+    if dlen <= 2:
+        out[:, :, STD] = 0
+    return out
 
 
 class Condense(object):
@@ -45,42 +102,261 @@ class Condense(object):
         self._sound = sound
 
     def __len__(self):
-        return len(self._sound)
+        return self._sound.numframes()
+
+    def __call__(self, start, width, density):
+        # Only read the frames covered by the cells.
+        start = int(start)
+        width = int(width)
+        offset = max(0, int(round((start - 0.25) * density)))
+        stop = int(round((start + width + 0.25) * density))
+        data = self._sound.read(offset, stop)
+        return _condense(data, start, width, density, offset, len(self))
+
+    def windows(self, a, b):
+        """Return the cells for the frames from a[i] to b[i]."""
+        if not len(a):
+            return _windows(self._sound.read(0, 0), a, b, 0, len(self))
+        offset = a.min()
+        data = self._sound.read(offset, b.max())
+        return _windows(data, a, b, offset, len(self))
+
+    def update(self, start, end, delta):
+        # Cells are computed from the sound when they are requested.
+        pass
 
-    def __call__(self, *args):
-        return [_condense(ch, *args) for ch in self._sound.transpose()]
+
+# Frames per cell in the base level of the pyramid.
+BASE_DENSITY = 256
+
+
+def _level_sizes(n):
+    """Return the number of cells of each level of a pyramid whose base
+    level has n cells."""
+    sizes = [n]
+    while n > 1:
+        n = (n + 1) // 2
+        sizes.append(n)
+    return sizes
+
+
+def _halve(bounds):
+    """Return the bounds of the cells that merge the cells with the
+    given bounds two by two."""
+    return numpy.append(bounds[:-1:2], bounds[-1])
+
+
+def _pairs(level, bounds):
+    """Merge the cells of level two by two. Return the merged cells and
+    their bounds."""
+    n = level.shape[1]
+    if not n:
+        return level, bounds
+    a = numpy.arange(0, n, 2)
+    return _reduce(level, a, numpy.minimum(a + 2, n)), _halve(bounds)
+
+
+def _nearest(bounds, p):
+    """Return the index of the bound nearest to each position p."""
+    j = numpy.searchsorted(bounds, p, side='right') - 1
+    j = numpy.clip(j, 0, len(bounds) - 2)
+    return j + (2 * p >= bounds[j] + bounds[j + 1])
 
 
 class Downsample(object):
+    """Summarizes the source in a pyramid of levels: level k holds the
+    cells for base_density * 2 ** k frames, each one merging two cells
+    of the level below. Requests are answered from the closest level
+    below their density, in a time proportional to their width. Lower
+    densities are left to the source.
+
+    The frames covered by the cells of each level are given by their
+    bounds: the first frame of each cell, and the end of the last one.
+    They are evenly spaced until update() is called: cells that cover
+    an edit are then computed again, and the ones after it cover the
+    same frames, shifted. Frames found at the end of the source beyond
+    the edit, such as the ones of a sound still being decoded, are
+    taken in as if appended, and not again when they are notified.
+
+    """
+
+    # Number of cells computed at once, to bound the amount of frames
+    # read in memory.
+    chunk = 1024
 
-    def __init__(self, source, threshold_density=2048):
+    def __init__(self, source, base_density=BASE_DENSITY, key=None):
+        """If key is given, the levels are loaded from the peaks cache
+        under that key, or computed and saved there."""
         self._source = source
-        self._threshold = threshold_density
-        self._density = 0.5 * threshold_density
-        width = int(float(len(source)) / self._density)
-        self._values = source(0, width, self._density)
+        self._base = float(base_density)
+        self._length = len(source)
+        # Frames at the end of the levels that have not been notified
+        # to update() yet.
+        self._ahead = 0
+        self._levels = None
+        if key is not None:
+            self._levels = self._load(key)
+        if self._levels is None:
+            self._levels = self._compute()
+            if key is not None and self._levels[0].shape[1]:
+                peaks.save(key, numpy.concatenate(self._levels, axis=1))
+        self._bounds = self._even_bounds()
+
+    def _even_bounds(self):
+        n = self._levels[0].shape[1]
+        bounds = [_round(numpy.arange(n + 1) * self._base).astype(
+            numpy.int64)]
+        for level in self._levels[1:]:
+            bounds.append(_halve(bounds[-1]))
+        return bounds
+
+    def _compute(self):
+        width = int(len(self._source) / self._base) + 1
+        level = numpy.concatenate(
+            [self._source(start, min(self.chunk, width - start), self._base)
+             for start in range(0, width, self.chunk)], axis=1)
+        # Levels are stored in single precision, which is plenty for
+        # drawing.
+        level = level.astype(numpy.float32)
+        levels = [level]
+        while level.shape[1] > 1:
+            n = level.shape[1]
+            a = numpy.arange(0, n, 2)
+            level = _reduce(level, a, numpy.minimum(a + 2, n))
+            levels.append(level)
+        return levels
+
+    def _windows(self, bounds, n):
+        # Cells overlap their neighbours by a quarter of the base cell,
+        # as in _condense(). n is the number of frames of the source
+        # that the levels cover.
+        margin = int(round(self._base / 4))
+        a = numpy.minimum(numpy.maximum(bounds[:-1] - margin, 0), n - 1)
+        b = numpy.maximum(numpy.minimum(bounds[1:] + margin, n), a + 1)
+        cells = [self._source.windows(a[i:i + self.chunk],
+                                      b[i:i + self.chunk])
+                 for i in range(0, len(a), self.chunk)]
+        return numpy.concatenate(cells, axis=1).astype(numpy.float32)
+
+    def update(self, start, end, delta):
+        """Update the levels after the frames of the source from start
+        to end have been replaced, and the source got delta frames
+        longer."""
+        n = len(self)
+        length = self._length
+        if start == end and start >= length - self._ahead and delta > 0:
+            # Frames appended to the source, some of which the levels
+            # may already hold.
+            taken = min(delta, self._ahead)
+            self._ahead -= taken
+            start = end = length
+            delta -= taken
+        expected = length + delta
+        self._length = n
+        if n < expected or not expected or not length or \
+                not self._levels[0].shape[1]:
+            # The levels are computed again when the source is or was
+            # empty, or when it is shorter than the edit tells: the
+            # levels may have held frames that were not notified.
+            self._ahead = max(0, n - expected)
+            self._levels = self._compute()
+            self._bounds = self._even_bounds()
+            return
+        if delta or start < length:
+            self._update(start, end, delta, expected)
+        if n > expected:
+            self._ahead += n - expected
+            self._update(expected, expected, n - expected, n)
+
+    def _update(self, start, end, delta, n):
+        # Base level: the cells whose frames overlap the edit.
+        bounds = self._bounds[0]
+        margin = int(round(self._base / 4)) + 1
+        lo = numpy.searchsorted(bounds[1:], start - margin, side='right')
+        hi = numpy.searchsorted(bounds[:-1], max(end, start + 1) + margin)
+        a, b = bounds[lo], bounds[hi] + delta
+        m = max(1, int(round((b - a) / self._base)))
+        new = _round(a + numpy.arange(m + 1) * ((b - a) / float(m)))
+        new = new.astype(numpy.int64)
+        cells = self._windows(new, n)
+
+        levels, all_bounds = [], []
+        for k, level in enumerate(self._levels):
+            bounds = self._bounds[k]
+            if k:
+                # The cells over the frames computed again in the level
+                # below, whose bounds are also bounds of this level.
+                lo = numpy.searchsorted(bounds[1:], a, side='right')
+                hi = numpy.searchsorted(bounds[:-1], b - delta)
+                a, b = bounds[lo], bounds[hi] + delta
+                below, below_bounds = levels[-1], all_bounds[-1]
+                i = numpy.searchsorted(below_bounds, a)
+                j = numpy.searchsorted(below_bounds, b)
+                cells, new = _pairs(below[:, i:j], below_bounds[i:j + 1])
+            levels.append(numpy.concatenate(
+                (level[:, :lo], cells, level[:, hi:]), axis=1))
+            all_bounds.append(numpy.concatenate(
+                (bounds[:lo], new, bounds[hi + 1:] + delta)))
+
+        # The top level holds a single cell.
+        while levels[-1].shape[1] > 1:
+            level, bounds = _pairs(levels[-1], all_bounds[-1])
+            levels.append(level)
+            all_bounds.append(bounds)
+        while len(levels) > 1 and levels[-2].shape[1] == 1:
+            levels.pop()
+            all_bounds.pop()
+        self._levels, self._bounds = levels, all_bounds
+
+    def _load(self, key):
+        summary = peaks.load(key)
+        if summary is None:
+            return None
+        # Levels are stored one after the other; the base level has
+        # about half of the cells.
+        sizes = _level_sizes((summary.shape[1] + 1) // 2)
+        while sum(sizes) > summary.shape[1] and sizes[0] > 1:
+            sizes = _level_sizes(sizes[0] - 1)
+        if sum(sizes) != summary.shape[1]:
+            return None
+        levels = []
+        start = 0
+        for n in sizes:
+            levels.append(summary[:, start:start + n])
+            start += n
+        return levels
 
     def __len__(self):
         return len(self._source)
 
     def __call__(self, start, width, density):
-        if density < self._threshold:
+        if density < self._base:
             return self._source(start, width, density)
-        out = []
-        density /= self._density
-        for in_channel in self._values:
-            out_channel = []
-            for out_x in range(0, width):
-                in_start = int(round((start + out_x) * density))
-                in_stop = int(round((start + out_x + 1) * density))
-                in_stop = min(in_stop, len(in_channel))
-                out_v = _merge_cells(in_channel[in_start:in_stop])
-                out_channel.append(out_v)
-            out.append(out_channel)
-        return out
+        k = int(numpy.log2(density / self._base))
+        k = min(k, len(self._levels) - 1)
+        level = self._levels[k]
+        bounds = self._bounds[k]
+        n = level.shape[1]
+        x = numpy.arange(start, start + width, dtype=numpy.float64)
+        if n:
+            a = _nearest(bounds, x * density)
+            b = _nearest(bounds, (x + 1) * density)
+            keep = a < n
+            a, b = a[keep], numpy.minimum(b[keep], n)
+            numpy.maximum(b, a + 1, out=b)
+        if not n or not len(a):
+            return numpy.zeros((len(level), 0, 4), dtype=level.dtype)
+        return _reduce(level, a, b)
 
 
 class Scroll(object):
+    """Keeps the cells of the last request, to compute only the new
+    ones when the view is scrolled.
+
+    Requests and updates are serialized, so that the levels of the
+    source are never read while they are being updated.
+
+    """
 
     def __init__(self, source):
         self._source = source
@@ -88,6 +364,7 @@ class Scroll(object):
         self._width = 0
         self._density = 0
         self._values = None
+        self._lock = threading.Lock()
 
     def __len__(self):
         return len(self._source)
@@ -96,23 +373,28 @@ class Scroll(object):
         return self._source(start, width, self._density)
 
     def __call__(self, start, width, density):
+        with self._lock:
+            return self._scroll(start, width, density)
+
+    def _scroll(self, start, width, density):
         values = None
         if self._values is not None and self._density == density:
             stop = start + width
             self_stop = self._start + self._width
             if start == self._start and stop == self_stop:
                 values = self._values
-            elif start < self._start and stop > self._start:
-                values = self._calc(start, self._start - start)
-                keep_width = stop - self._start
-                for i, channel in enumerate(self._values):
-                    values[i] = values[i] + channel[:keep_width]
-            elif stop > self_stop and start < self_stop:
-                values = self._calc(self_stop, stop - self_stop)
-                keep_start = start - self._start
-                for i, channel in enumerate(self._values):
-                    values[i] = channel[keep_start:] + values[i]
-        if not values:
+            elif start < self_stop and stop > self._start:
+                # The cells in view that were already computed are
+                # kept, and the ones on either side are computed.
+                keep_start = max(start, self._start) - self._start
+                keep_stop = min(stop, self_stop) - self._start
+                parts = [self._values[:, keep_start:keep_stop]]
+                if start < self._start:
+                    parts.insert(0, self._calc(start, self._start - start))
+                if stop > self_stop:
+                    parts.append(self._calc(self_stop, stop - self_stop))
+                values = numpy.concatenate(parts, axis=1)
+        if values is None:
             self._density = density
             values = self._calc(start, width)
         self._start = start
@@ -120,7 +402,196 @@ class Scroll(object):
         self._values = values
         return self._values
 
+    def update(self, start, end, delta):
+        """Update the source after the frames from start to end have
+        been replaced, and the sound got delta frames longer."""
+        with self._lock:
+            self._source.update(start, end, delta)
+            self._values = None
+
 
 def Overview(sound):
-    return Scroll(Downsample(Condense(sound)))
+    key = peaks.key(sound, base_density=BASE_DENSITY)
+    return Scroll(Downsample(Condense(sound), BASE_DENSITY, key))
+
+
+
+if __name__ == '__main__':
+    # Cells match the statistics of their overlapping windows.
+    x = numpy.random.uniform(-1, 1, (1000, 2))
+    for density in [1, 2.5, 7, 300]:
+        width = int(len(x) / density) + 2
+        cells = _condense(x, 0, width, density, 0, len(x))
+        assert len(cells) == 2
+        for c, channel in enumerate(cells):
+            for i, cell in enumerate(channel):
+                a = max(0, int(round((i - 0.25) * density)))
+                b = int(round((i + 1.25) * density))
+                d = x[a:b, c]
+                assert (cell[MIN], cell[MAX]) == (d.min(), d.max())
+                assert numpy.allclose([cell[MEAN], cell[STD]],
+                                      [d.mean(), d.std()])
+            assert int(round((len(channel) - 0.25) * density)) >= len(x)
+
+    # Requests above the base density are answered from the pyramid.
+    class Frames(object):
+        def __init__(self, frames):
+            self.frames = frames
+        def numframes(self):
+            return len(self.frames)
+        def read(self, start, end):
+            return self.frames[start:end]
+
+    ramp = numpy.linspace(-1, 1, 100000)
+    x = numpy.array([ramp, numpy.random.uniform(-1, 1, len(ramp))]).T
+    d = Downsample(Condense(Frames(x)), base_density=64)
+    assert (d(0, 10, 10) == Condense(Frames(x))(0, 10, 10)).all()
+    for density in [64, 100, 128, 1000, 5000, 100000, 300000]:
+        width = int(len(x) / density)
+        cells = d(0, width + 5, density)
+        assert cells.shape[0] == 2 and cells.shape[2] == 4
+        assert width <= cells.shape[1] <= width + 2
+        # Cells of the level may start and end up to half a cell away
+        # from the requested ones.
+        for i in range(width):
+            a = int((i + 0.5) * density)
+            # Levels are stored in single precision.
+            for c in range(2):
+                assert cells[c, i, MIN] - 1e-6 <= x[a, c] <= \
+                       cells[c, i, MAX] + 1e-6
+            assert abs(cells[0, i, MEAN] - ramp[a]) < density * 2. / len(x)
+        if width:
+            assert abs(cells[1, :width, STD] - 1 / 3. ** .5).max() < 0.2
+
+    # Scrolling reuses the cells already computed.
+    calls = []
+    class Source(Condense):
+        def __call__(self, start, width, density):
+            calls.append((start, width))
+            return Condense.__call__(self, start, width, density)
+    scroll = Scroll(Source(Frames(x)))
+    a = scroll(10, 100, 3)
+    b = scroll(30, 100, 3)
+    c = scroll(0, 100, 3)
+    assert calls == [(10, 100), (110, 20), (0, 30)]
+    assert (b == Condense(Frames(x))(30, 100, 3)).all()
+    assert (c == Condense(Frames(x))(0, 100, 3)).all()
+    scroll(30, 40, 3)
+    del calls[:]
+    d = scroll(20, 60, 3)
+    assert calls == [(20, 10), (70, 10)]
+    assert (d == Condense(Frames(x))(20, 60, 3)).all()
+
+    # Levels saved in the peaks cache are memory-mapped back.
+    import shutil, tempfile
+    peaks.CACHE_DIR = tempfile.mkdtemp()
+    for n in [1, 2, 3, 1000, 1563]:
+        sizes = _level_sizes(n)
+        assert sizes[0] == n and sizes[-1] == 1
+    d = Downsample(Condense(Frames(x)), base_density=64, key='test')
+    del calls[:]
+    cached = Downsample(Source(Frames(x)), base_density=64, key='test')
+    assert calls == []
+    assert isinstance(cached._levels[-1], numpy.memmap)
+    assert [l.shape for l in cached._levels] == [l.shape for l in d._levels]
+    for density in [64, 1000, 100000]:
+        assert (cached(7, 50, density) == d(7, 50, density)).all()
+    shutil.rmtree(peaks.CACHE_DIR)
+
+    # Edits only compute again the cells that cover them, and shift the
+    # others.
+    def check(d, frames):
+        n = len(frames)
+        for k, (level, bounds) in enumerate(zip(d._levels, d._bounds)):
+            assert len(bounds) == level.shape[1] + 1
+            assert (numpy.diff(bounds) > 0).all()
+            if k:
+                assert set(bounds) <= set(d._bounds[k - 1])
+            for j in range(level.shape[1]):
+                a = min(max(bounds[j] - 16, 0), n - 1)
+                b = max(min(bounds[j + 1] + 16, n), a + 1)
+                w = frames[a:b].astype(numpy.float32)
+                assert (level[:, j, MIN] == w.min(axis=0)).all()
+                assert (level[:, j, MAX] == w.max(axis=0)).all()
+        assert d._levels[-1].shape[1] == 1
+
+    reads = []
+    class Edited(Frames):
+        def read(self, start, end):
+            reads.append(max(0, min(end, len(self.frames)) - start))
+            return self.frames[start:end]
+
+    x = numpy.random.uniform(-1, 1, (100000, 2))
+    frames = Edited(x)
+    d = Downsample(Condense(frames), base_density=64)
+    check(d, x)
+    for start, end, length in [(1000, 1000, 50), (5000, 7000, 0),
+                               (0, 10, 10), (90000, 100000, 300),
+                               (20000, 20001, 5000), (90300, 90300, 7),
+                               (50, 30000, 100000)]:
+        end = min(end, len(x))
+        clip = numpy.random.uniform(-2, 2, (length, 2))
+        x = numpy.concatenate((x[:start], clip, x[end:]))
+        frames.frames = x
+        del reads[:]
+        d.update(start, end, length - (end - start))
+        assert sum(reads) <= end - start + length + 4 * 64
+        check(d, x)
+        assert (d(0, 200, len(x) / 200.)[:, :, MAX].max(axis=1) ==
+                x.astype(numpy.float32).max(axis=0)).all()
+
+    # The whole sound is removed, then replaced.
+    frames.frames = x[:0]
+    d.update(0, len(x), -len(x))
+    assert d(0, 10, 64).shape == (2, 0, 4)
+    frames.frames = x[:1000]
+    d.update(0, 0, 1000)
+    check(d, x[:1000])
+
+    # Levels that already hold the new frames are computed again.
+    frames.frames = x[:1500]
+    d = Downsample(Condense(frames), base_density=64)
+    d.update(1000, 1000, 500)
+    check(d, x[:1500])
+
+    # Frames appended after the notification was sent are taken in
+    # once, as the sound keeps loading.
+    frames.frames = x[:3000]
+    del reads[:]
+    d.update(1500, 1500, 500)
+    assert sum(reads) <= 1500 + 4 * 64
+    check(d, x[:3000])
+    del reads[:]
+    d.update(2000, 2000, 1000)
+    assert reads == []
+    check(d, x[:3000])
+    frames.frames = x[:3200]
+    d.update(3000, 3000, 200)
+    check(d, x[:3200])
+    # An edit followed by frames that were not notified yet.
+    y = numpy.concatenate((x[:100], x[150:3200], x[:10000]))
+    frames.frames = y
+    del reads[:]
+    d.update(100, 150, -50)
+    assert sum(reads) <= 10000 + 8 * 64
+    check(d, y)
+    d.update(3150, 3150, 10000)
+    check(d, y)
+    assert d._ahead == 0
 
+    # The view is not read while it is updated.
+    import time
+    class Slow(Downsample):
+        def update(self, start, end, delta):
+            time.sleep(0.2)
+            Downsample.update(self, start, end, delta)
+    frames.frames = x
+    scroll = Scroll(Slow(Condense(frames), base_density=64))
+    scroll(0, 10, 100)
+    x = numpy.concatenate((x, x))
+    frames.frames = x
+    thread = threading.Thread(target=scroll.update, args=(1500, 1500, 1500))
+    thread.start()
+    time.sleep(0.05)
+    assert scroll(0, 10, 300).shape[1] == 10
+    thread.join()
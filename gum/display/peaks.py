@@ -0,0 +1,143 @@
+# On-disk cache of overview summaries.
+#
+# The summary of a sound file is saved as a .npy file in the cache
+# directory, named after a key made of the path, size and modification
+# time of the sound file, and a hash of a few samples of its content.
+# When the file is opened again, the summary is memory-mapped instead
+# of being computed from every frame.
+
+from gum.lib import audiofile
+import numpy
+import tempfile
+import hashlib
+import json
+import os
+
+CACHE_DIR = os.path.join(audiofile.CACHE_DIR, 'peaks')
+
+# Bump when the summary format changes.
+VERSION = 1
+
+# Number and size of the chunks of the file that are hashed.
+SAMPLES = 16
+SAMPLE_SIZE = 65536
+
+# Number of summaries kept in the cache; the least recently used are
+# removed first.
+MAX_FILES = 200
+
+
+def _sample_hash(path, size):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for i in range(SAMPLES):
+            f.seek(max(0, size - SAMPLE_SIZE) * i // max(SAMPLES - 1, 1))
+            h.update(f.read(SAMPLE_SIZE))
+    return h.hexdigest()
+
+
+def key(sound, **parameters):
+    """Return the cache key for the summary of sound, or None if sound
+    does not hold the unmodified frames of a file. parameters are those
+    of the summary, which are part of the key."""
+    path = sound.filename
+    if path is None or sound.is_loading() or not sound.is_saved():
+        return None
+    try:
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        digest = _sample_hash(path, st.st_size)
+    except (IOError, OSError):
+        return None
+    k = {'version': VERSION, 'path': path, 'size': st.st_size,
+         'mtime': st.st_mtime, 'hash': digest, 'parameters': parameters}
+    return hashlib.sha1(json.dumps(k, sort_keys=True)).hexdigest()
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, key + '.npy')
+
+
+def load(key):
+    """Return the summary saved under key as a read-only memory-mapped
+    array, or None."""
+    path = _path(key)
+    try:
+        summary = numpy.load(path, mmap_mode='r')
+        os.utime(path, None)
+    except (IOError, OSError, ValueError):
+        return None
+    return summary
+
+
+def _prune():
+    files = [os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR)
+             if name.endswith('.npy')]
+    if len(files) <= MAX_FILES:
+        return
+    files.sort(key=os.path.getmtime)
+    for path in files[:len(files) - MAX_FILES]:
+        os.remove(path)
+
+
+def save(key, summary):
+    """Save the summary array under key. Errors are ignored: the cache
+    is only an optimization."""
+    try:
+        if not os.path.isdir(CACHE_DIR):
+            os.makedirs(CACHE_DIR)
+        tempfd, temppath = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        with os.fdopen(tempfd, 'wb') as f:
+            numpy.save(f, summary)
+        os.rename(temppath, _path(key))
+        _prune()
+    except (IOError, OSError):
+        pass
+
+
+if __name__ == '__main__':
+    import shutil
+
+    class FakeSound(object):
+        def __init__(self, filename, saved=True):
+            self.filename = filename
+            self._saved = saved
+        def is_loading(self):
+            return False
+        def is_saved(self):
+            return self._saved
+
+    CACHE_DIR = tempfile.mkdtemp()
+    fd, filename = tempfile.mkstemp(suffix='.wav')
+    os.write(fd, 'x' * 300000)
+    os.close(fd)
+
+    k = key(FakeSound(filename), density=256)
+    assert k is not None
+    assert k == key(FakeSound(filename), density=256)
+    assert k != key(FakeSound(filename), density=128)
+    assert key(FakeSound(filename, saved=False)) is None
+    assert key(FakeSound(None)) is None
+
+    assert load(k) is None
+    summary = numpy.arange(24, dtype=numpy.float32).reshape(2, 3, 4)
+    save(k, summary)
+    loaded = load(k)
+    assert isinstance(loaded, numpy.memmap)
+    assert (loaded == summary).all()
+
+    # Changing the content changes the key.
+    with open(filename, 'r+b') as f:
+        f.seek(150000)
+        f.write('y')
+    os.utime(filename, (0, 0))
+    assert key(FakeSound(filename), density=256) not in (k, None)
+
+    # Old summaries are removed.
+    MAX_FILES = 2
+    for name in ['a', 'b', 'c']:
+        save(name, summary)
+    assert sorted(os.listdir(CACHE_DIR)) == ['b.npy', 'c.npy']
+
+    shutil.rmtree(CACHE_DIR)
+    os.remove(filename)
@@ -1,7 +1,6 @@
 import colorsys
 import numpy as np
-import cairo
-from overview import Overview
+from overview import Overview, MIN, MAX, MEAN, STD
 from collections import namedtuple
 
 _Colors = namedtuple('_Colors', 'grid main fore')
@@ -18,6 +17,11 @@ class Waveform(object):
         forecolor = colorsys.hls_to_rgb(hue, 0.75, 1.0)
         self._colors = _Colors(gridcolor, maincolor, forecolor)
 
+    def update(self, start, end, delta):
+        """The frames of the sound from start to end have been replaced,
+        and the sound got delta frames longer."""
+        self._overview.update(start, end, delta)
+
     def set(self, start, width, density):
         self._view = (int(start), int(width), float(density))
         self._density = density
@@ -62,9 +66,10 @@ class Waveform(object):
         context.translate(0, height)
         context.scale(1.0, -1.0)
         context.set_source_rgb(*self._colors.main)
-        context.move_to(0, data[0].mean * height)
+        means = data[:, MEAN] * height
+        context.move_to(0, means[0])
         for i in range(1, len(data)):
-            context.line_to(i, data[i].mean * height)
+            context.line_to(i, means[i])
         context.stroke()
         context.restore()
 
@@ -76,24 +81,28 @@ class Waveform(object):
         context.scale(1.0, -1.0)
         r, g, b = self._colors.main
         context.set_source_rgba(r, g, b, alpha)
-        context.move_to(0, data[0].min * height)
+        mins = data[:, MIN] * height
+        maxs = data[:, MAX] * height
+        context.move_to(0, mins[0])
         for i in range(1, len(data)):
-            context.line_to(i, data[i].min * height - 0.5)
+            context.line_to(i, mins[i] - 0.5)
         for i in range(0, len(data)-1):
-            context.line_to(width - i, data[-i].max * height + 0.5)
+            context.line_to(width - i, maxs[-i] + 0.5)
         context.close_path()
         context.fill()
         context.restore()
 
     def _draw_gradient(self, data, context, width, height, alpha):
+        import cairo
         ypix, xpix = np.mgrid[:height, :width]
         yidx = 1 - (ypix.astype(np.float) / (float(height)/2))
 
-        iota = np.fromiter((0.000001 for c in data), dtype=np.float)
-        mins = np.fromiter((c.min for c in data), dtype=np.float)
-        maxs = np.fromiter((c.max for c in data), dtype=np.float)
-        avgs = np.fromiter((c.mean for c in data), dtype=np.float)
-        stds = np.fromiter((c.std for c in data), dtype=np.float)
+        iota = np.empty(len(data))
+        iota.fill(0.000001)
+        mins = data[:, MIN].astype(np.float)
+        maxs = data[:, MAX].astype(np.float)
+        avgs = data[:, MEAN].astype(np.float)
+        stds = data[:, STD].astype(np.float)
         lopks = avgs - mins
         hipks = maxs - avgs
         peaks = (lopks * (lopks >= hipks)) + (hipks * (hipks > lopks))
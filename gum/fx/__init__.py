@@ -0,0 +1,13 @@
+# Effects provided by the plugins of this package, declared here so that
+# a plugin module is only imported when one of its effects is first
+# invoked. Maps a menu name to a module name in this package. Plugins
+# that are not listed are loaded at startup.
+manifest = {
+    'Bit Crusher': 'bitcrusher',
+    'Convolve with clipboard': 'convolution',
+    'Monoize': 'monoize',
+    'Filter: High Pass': 'svf',
+    'Filter: Band Pass': 'svf',
+    'Filter: Low Pass': 'svf',
+    'Volume': 'volume',
+}
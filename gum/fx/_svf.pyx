@@ -1,32 +1,93 @@
 import numpy
 cimport numpy
+cimport cython
+from libc.math cimport sin, M_PI
 
 DTYPE = numpy.float64
-ctypedef numpy.float64_t DTYPE_t
-
-def svf(numpy.ndarray[DTYPE_t, ndim=1] x not None,
-        float f, float damping, int samplerate):
-    """State variable filters. DAFX book, Section 2.2, page 36."""
-    cdef float F
-    cdef float Q
-    cdef Py_ssize_t l
-    cdef numpy.ndarray[DTYPE_t, ndim=1] yh
-    cdef numpy.ndarray[DTYPE_t, ndim=1] yb
-    cdef numpy.ndarray[DTYPE_t, ndim=1] yl
-    cdef Py_ssize_t n
-    
-    F = 2 * numpy.sin(numpy.pi * f / samplerate)
-    Q = 2 * damping
-    l = len(x)
-    yh = numpy.zeros(l, dtype=DTYPE)
-    yb = numpy.zeros(l, dtype=DTYPE)
-    yl = numpy.zeros(l, dtype=DTYPE)
-
-    n = 0
-    while n < l:
-        yh[n] = x[n] - yl[n-1] - Q * yb[n-1]
-        yb[n] = F * yh[n] + yb[n-1]
-        yl[n] = F * yb[n] + yl[n-1]
-        n = n + 1
-
-    return yh, yb, yl
+
+# Responses, as indexes in the tuple returned by svf().
+HIGH_PASS = 0
+BAND_PASS = 1
+LOW_PASS = 2
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _filter(const double[:, :] x, double[:, :] y, double F, double Q,
+                  int output, double[:, :] state) nogil:
+    # Filter each column of x, writing the output response to y:
+    # 0 for high pass, 1 for band pass, 2 for low pass.
+    cdef Py_ssize_t c, n
+    cdef double h, b, l
+    for c in range(x.shape[1]):
+        b = state[c, 0]
+        l = state[c, 1]
+        for n in range(x.shape[0]):
+            h = x[n, c] - l - Q * b
+            b = F * h + b
+            l = F * b + l
+            if output == 0:
+                y[n, c] = h
+            elif output == 1:
+                y[n, c] = b
+            else:
+                y[n, c] = l
+        state[c, 0] = b
+        state[c, 1] = l
+
+
+def svf_frames(numpy.ndarray x not None, double f, double damping,
+               int samplerate, int output=LOW_PASS,
+               numpy.ndarray state=None):
+    """Filter a block of float64 frames and return one response.
+
+    x has one column per channel, or is 1-D for a single channel.
+    output is HIGH_PASS, BAND_PASS or LOW_PASS. state is a float64
+    array of shape (channels, 2) holding the band pass and low pass
+    outputs for the frame before x, zero if omitted. It is updated so
+    that the next block can be filtered. x may be read-only. The GIL is
+    released while filtering.
+
+    """
+    cdef double F = 2 * sin(M_PI * f / samplerate)
+    cdef double Q = 2 * damping
+    cdef const double[:, :] frames
+    cdef double[:, :] y
+    cdef double[:, :] s
+
+    if x.ndim == 1:
+        frames = x.reshape(-1, 1)
+    else:
+        frames = x
+    out = numpy.empty((frames.shape[0], frames.shape[1]), dtype=DTYPE)
+    y = out
+    if state is None:
+        state = numpy.zeros((frames.shape[1], 2), dtype=DTYPE)
+    s = state
+    with nogil:
+        _filter(frames, y, F, Q, output, s)
+    if x.ndim == 1:
+        return out.reshape(-1)
+    return out
+
+
+def svf(numpy.ndarray x not None, double f, double damping,
+        int samplerate, numpy.ndarray state=None):
+    """State variable filters. DAFX book, Section 2.2, page 36.
+
+    Return the high pass, band pass and low pass responses of the
+    float64 samples x. state holds the band pass and low pass outputs
+    for the sample before x, zero if omitted. It is updated so that the
+    next block can be filtered. x may be read-only.
+
+    """
+    s = numpy.zeros((1, 2), dtype=DTYPE)
+    if state is not None:
+        s[0] = state
+    y = []
+    for output in (HIGH_PASS, BAND_PASS, LOW_PASS):
+        t = s.copy()
+        y.append(svf_frames(x, f, damping, samplerate, output, t))
+    if state is not None:
+        state[:] = t[0]
+    return tuple(y)
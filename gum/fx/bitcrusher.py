@@ -12,20 +12,20 @@ def bitcrush(x, nbits=4):
 
 def bitcrusher(sound, start, end):
 
-    def process(nbits):
-        y = bitcrush(sound.frames[start:end], nbits)
-        sound.paste(start, end, y)
+    def processor(parameters):
+        nbits = parameters['Bit Width']
+        return effect.Map(lambda x: bitcrush(x, nbits))
 
     def callback(parameters):
-        nbits = parameters['Bit Width']
         global nbits_last
-        nbits_last = nbits
-        process(nbits)
+        nbits_last = parameters['Bit Width']
+        effect.stream(sound, start, end, processor(parameters))
 
     d = EffectDialog('BitCrusher')
     global nbits_last
     d.add_slider('Bit Width', nbits_last, 2, 12)
     d.callback = callback
+    d.processor = processor
 
     return d
 
@@ -1,4 +1,4 @@
-from gum.lib import edit
+from gum.lib import edit, parallel
 from gum.controllers import effect
 from gum.models import clipboard, sound
 import numpy
@@ -11,54 +11,302 @@ def nextpow2(n):
     return p
 
 
+# Largest FFT size chosen by fft_size(), unless the kernel is longer.
+MAX_FFT_SIZE = 2 ** 22
+
+def fft_size(m):
+    """Return the FFT size that convolves with a kernel of m samples at
+    the lowest cost per output sample."""
+    best, cost = None, None
+    size = 2 ** nextpow2(m)
+    while best is None or size <= MAX_FFT_SIZE:
+        step = size - m + 1
+        c = size * numpy.log2(max(size, 2)) / step
+        if cost is None or c < cost:
+            best, cost = size, c
+        size *= 2
+    return best
+
+
 def ola_fftconvolve(x, h):
     # http://www.dspdesignline.com/showArticle.jhtml?articleID=199901970
-    Nfft = 2 ** nextpow2(len(h))
-    H = numpy.fft.fft(h, Nfft)
-    lslice = Nfft - len(h) + 1 # because lslice + len(h) - 1 == Nfft
-    numslices = int(numpy.ceil(float(len(x)) / lslice))
-    y = numpy.zeros(numslices * lslice + len(h) - 1)
-    start = 0
-    while start < len(x):
-        slice = x[start:start + lslice]
-        X = numpy.fft.fft(slice, Nfft)
-        Y = X * H
-        y[start:start+Nfft] += numpy.real(numpy.fft.ifft(Y, Nfft))
-        start = start + lslice
-    return y
+    c = Convolution(h, 1)
+    y = [c.process(x), c.flush()]
+    return numpy.concatenate([block for block in y if block is not None])
 
 
-def convolution(sound, start, end):
+class Convolution(effect.Processor):
+    """Convolve blocks of frames with h, by overlap-add with real FFTs.
 
-    x = sound.frames
-    h = clipboard.clip
+    The spectrum of each channel of h is computed once. Input frames
+    are buffered until a whole number of FFT slices is available, so
+    the output of process() may lag behind its input. The output is
+    len(h) - 1 frames longer than the input; flush() returns what is
+    left.
 
-    numchan = max(x.ndim, h.ndim)
-    if numchan == 1:
-        y = ola_fftconvolve(x[start:end], h)
-    else:
-        y = []
-        if h.ndim == 1:
-            #! H will be computed two times !
+    """
+
+    def __init__(self, h, numchan):
+        if numchan > 1 and h.ndim == 1:
             h = edit.mix_channels_auto(h, 2)
-        if x.ndim == 1:
+        h = h.reshape(len(h), -1)
+        self._numchan = numchan
+        self._m = len(h)
+        self._size = fft_size(self._m)
+        self._step = self._size - self._m + 1
+        self._H = [numpy.fft.rfft(channel, self._size)
+                   for channel in h.transpose()]
+        self._pending = []
+        self._numpending = 0
+        self._tail = numpy.zeros((self._m - 1, len(self._H)))
+
+    def _format(self, y):
+        if self._numchan == 1:
+            return y[:, 0]
+        return y
+
+    def _convolve_channel(self, args):
+        # x holds a whole number of slices. The tail of each slice is
+        # shorter than a slice, so it only overlaps the next one.
+        x, c = args
+        size, step, m = self._size, self._step, self._m
+        rows = x.reshape(-1, step)
+        k = len(rows)
+        Y = numpy.fft.rfft(rows, size, axis=1)
+        Y *= self._H[c]
+        y = numpy.fft.irfft(Y, size, axis=1)
+        out = numpy.zeros((k + 1) * step)
+        out[:k * step] = y[:, :step].ravel()
+        tails = numpy.zeros((k, step))
+        tails[:, :m - 1] = y[:, step:]
+        out[step:] += tails.ravel()
+        out[:m - 1] += self._tail[:, c]
+        return out[:k * step], out[k * step:k * step + m - 1]
+
+    def _convolve(self, x):
+        results = parallel.map(self._convolve_channel,
+                               [(x[:, c], c) for c in range(len(self._H))])
+        self._tail = numpy.array([tail for y, tail in results]).transpose()
+        return numpy.array([y for y, tail in results]).transpose()
+
+    def process(self, x):
+        if self._numchan > 1 and x.ndim == 1:
             x = edit.mix_channels_auto(x, 2)
-        h = h.transpose()
-        x = x.transpose()
-        for nchan in range(2):
-            tmp = ola_fftconvolve(x[nchan][start:end], h[nchan])
-            y.append(tmp)
-        y = numpy.array(y)
-        y = y.transpose()
+        self._pending.append(x.reshape(len(x), -1))
+        self._numpending += len(x)
+        if self._numpending < self._step:
+            return None
+        x = numpy.concatenate(self._pending)
+        n = self._numpending - self._numpending % self._step
+        self._pending = [x[n:]]
+        self._numpending -= n
+        return self._format(self._convolve(x[:n]))
+
+    def flush(self):
+        r = self._numpending
+        y = self._tail
+        if r:
+            x = numpy.zeros((self._step, len(self._H)))
+            x[:r] = numpy.concatenate(self._pending)
+            y = numpy.concatenate((self._convolve(x), self._tail))
+        self._pending = []
+        self._numpending = 0
+        return self._format(y[:r + self._m - 1])
+
+
+class PartitionedConvolution(effect.Processor):
+    """Convolve blocks of frames with h, by uniformly partitioned
+    overlap-save.
+
+    h is cut into partitions of partition_size frames, whose spectra
+    are multiplied with those of the last inputs: FFTs are twice the
+    partition size, however long h is. Output is returned as soon as
+    a partition of input is complete. The output is len(h) - 1 frames
+    longer than the input; flush() returns what is left.
+
+    """
+
+    def __init__(self, h, numchan, partition_size=None):
+        if numchan > 1 and h.ndim == 1:
+            h = edit.mix_channels_auto(h, 2)
+        h = h.reshape(len(h), -1)
+        if partition_size is None:
+            partition_size = min(PARTITION_SIZE, 2 ** nextpow2(len(h)))
+        B = self._B = partition_size
+        P = -(-len(h) // B)
+        padded = numpy.zeros((P * B, h.shape[1]))
+        padded[:len(h)] = h
+        self._numchan = numchan
+        self._m = len(h)
+        self._H = [numpy.fft.rfft(channel.reshape(P, B), 2 * B, axis=1)
+                   for channel in padded.transpose()]
+        # For each channel: the spectra of the last P - 1 inputs, and
+        # the last block of input.
+        self._spectra = [numpy.zeros((P - 1, B + 1), complex)
+                         for channel in self._H]
+        self._last = [numpy.zeros(B) for channel in self._H]
+        self._pending = []
+        self._numpending = 0
+        self._numin = 0
+        self._numout = 0
+
+    def _format(self, y):
+        if self._numchan == 1:
+            return y[:, 0]
+        return y
+
+    def _convolve_channel(self, args):
+        # x holds a whole number of blocks.
+        x, c = args
+        B = self._B
+        H = self._H[c]
+        P = len(H)
+        blocks = numpy.concatenate((self._last[c], x)).reshape(-1, B)
+        k = len(blocks) - 1
+        X = numpy.fft.rfft(numpy.hstack((blocks[:-1], blocks[1:])), axis=1)
+        X = numpy.concatenate((self._spectra[c], X))
+        Y = numpy.zeros((k, B + 1), complex)
+        for p in range(P):
+            Y += X[P - 1 - p:P - 1 - p + k] * H[p]
+        self._spectra[c] = X[len(X) - (P - 1):]
+        self._last[c] = blocks[-1]
+        return numpy.fft.irfft(Y, 2 * B, axis=1)[:, B:].ravel()
+
+    def _convolve(self, x):
+        y = parallel.map(self._convolve_channel,
+                         [(x[:, c], c) for c in range(len(self._H))])
+        self._numout += len(x)
+        return numpy.array(y).transpose()
+
+    def process(self, x):
+        if self._numchan > 1 and x.ndim == 1:
+            x = edit.mix_channels_auto(x, 2)
+        self._pending.append(x.reshape(len(x), -1))
+        self._numpending += len(x)
+        self._numin += len(x)
+        if self._numpending < self._B:
+            return None
+        x = numpy.concatenate(self._pending)
+        n = self._numpending - self._numpending % self._B
+        self._pending = [x[n:]]
+        self._numpending -= n
+        return self._format(self._convolve(x[:n]))
+
+    def flush(self):
+        # Feed silence, a few blocks at a time, until the tail is out.
+        total = self._numin + self._m - 1
+        y = []
+        x = numpy.concatenate(self._pending + [numpy.zeros((0, len(self._H)))])
+        while self._numout < total:
+            n = min(total - self._numout, FLUSH_BLOCKS * self._B)
+            n += -n % self._B
+            block = numpy.zeros((n, len(self._H)))
+            block[:len(x)] = x
+            x = x[:0]
+            y.append(self._convolve(block))
+        self._pending = []
+        self._numpending = 0
+        if not y:
+            return None
+        y = numpy.concatenate(y)
+        return self._format(y[:len(y) - (self._numout - total)])
+
+
+# Kernels longer than PARTITION_SIZE frames are convolved by partitions
+# of that size. When flushing, FLUSH_BLOCKS partitions of silence are
+# fed at once.
+PARTITION_SIZE = 8192
+FLUSH_BLOCKS = 16
+
+def convolver(h, numchan):
+    """Return a processor that convolves with h."""
+    if len(h) > PARTITION_SIZE:
+        return PartitionedConvolution(h, numchan)
+    return Convolution(h, numchan)
+
+
+def convolution(sound, start, end):
+
+    h = clipboard.clip
+    numchan = max(sound.numchan(), h.ndim)
+    processor = convolver(h, numchan)
+    y = list(effect.render(sound, start, end, processor))
 
     # normalize
-    if y.any():
-        M = abs(y).max()
+    M = max([abs(block).max() for block in y] + [0])
+    if M != 0:
         factor = 1. / M
-        y = y * factor
+        for block in y:
+            block *= factor
 
-    l = len(sound.frames)
-    sound.paste(0, l, y)
+    # The selection is replaced with its convolution, reverb tail
+    # included; the rest of the sound is left as it is.
+    effect.paste_blocks(sound, start, end, y)
 
 
 effect.effects['Convolve with clipboard'] = convolution
+
+
+# Tests
+if __name__ == '__main__':
+    x = numpy.random.uniform(-1, 1, (5000, 2))
+    for m in [1, 10, 300, 4000]:
+        h = numpy.random.uniform(-1, 1, m)
+        ref = numpy.array([numpy.convolve(x[:, c], h) for c in range(2)])
+        ref = ref.transpose()
+        assert fft_size(m) >= m
+        assert numpy.allclose(ola_fftconvolve(x[:, 0], h), ref[:, 0])
+
+        # The output does not depend on the block size.
+        for blocksize in [7, 1000, 10000]:
+            c = Convolution(h, 2)
+            y = [c.process(x[i:i + blocksize])
+                 for i in range(0, len(x), blocksize)]
+            y = [block for block in y + [c.flush()] if block is not None]
+            y = numpy.concatenate(y)
+            assert y.shape == ref.shape
+            assert numpy.allclose(y, ref)
+
+    # Stereo kernel
+    h = numpy.random.uniform(-1, 1, (100, 2))
+    for c in [Convolution(h, 2), PartitionedConvolution(h, 2, 16)]:
+        y = numpy.concatenate([c.process(x), c.flush()])
+        assert numpy.allclose(y[:, 1], numpy.convolve(x[:, 1], h[:, 1]))
+
+    # Partitioned convolution: the output comes out one partition behind
+    # the input at most.
+    FLUSH_BLOCKS = 3
+    for m in [1, 64, 100, 3000]:
+        h = numpy.random.uniform(-1, 1, m)
+        ref = numpy.convolve(x[:, 0], h)
+        for blocksize in [7, 1000, 10000]:
+            c = PartitionedConvolution(h, 1, 64)
+            y = []
+            for i in range(0, len(x), blocksize):
+                block = c.process(x[i:i + blocksize, 0])
+                if block is not None:
+                    y.append(block)
+                done = sum(map(len, y))
+                assert min(i + blocksize, len(x)) - done < 64
+            y.append(c.flush())
+            y = numpy.concatenate(y)
+            assert y.shape == ref.shape
+            assert numpy.allclose(y, ref)
+    c = PartitionedConvolution(h, 1, 64)
+    assert c.flush().tolist() == [0] * (len(h) - 1)
+
+    # Only the selection is replaced.
+    x = numpy.random.uniform(-1, 1, 100)
+    h = numpy.random.uniform(-1, 1, 10)
+    clipboard.clip = h
+    snd = sound.Sound()
+    snd.frames = x
+    convolution(snd, 20, 50)
+    y = snd.frames
+    assert len(y) == len(x) + len(h) - 1
+    assert y[:20].tolist() == x[:20].tolist()
+    assert y[59:].tolist() == x[50:].tolist()
+    ref = numpy.convolve(x[20:50], h)
+    assert numpy.allclose(y[20:59], ref / abs(ref).max())
+    snd.undo()
+    assert snd.frames.tolist() == x.tolist()
@@ -11,6 +11,6 @@ def monoize(sound, start, end):
     do = (replace_frames, [sound, y])
     undo = (replace_frames, [sound, x])
     sound.history.add(do, undo)
-    sound.changed()
+    sound.notify()
 
 effect.effects['Monoize'] = monoize
@@ -1,68 +1,224 @@
-from gum.controllers.effect import effects
+from gum.controllers.effect import effects, Processor, stream
 from gum.views import EffectDialog
+from gum.lib import parallel
 import numpy
 import functools
 
 svf_index = {"High Pass": 0, "Band Pass": 1, "Low Pass": 2}
 
-def svf(x, f, damping, samplerate):
-    """State variable filters. DAFX book, Section 2.2, page 36."""
+# Number of samples that the numpy implementation filters at once.
+SVF_BLOCKSIZE = 1024
+
+def _powers(A, n):
+    """Return the matrices A ** k for k in range(n), by doubling."""
+    P = numpy.empty((n,) + A.shape)
+    P[0] = numpy.eye(len(A))
+    m = 1
+    Am = A
+    while m < n:
+        k = min(m, n - m)
+        P[m:m + k] = numpy.dot(P[:k], Am)
+        Am = numpy.dot(Am, Am)
+        m *= 2
+    return P
+
+def svf(x, f, damping, samplerate, state=None):
+    """State variable filters. DAFX book, Section 2.2, page 36.
+
+    state is a float64 array holding the band pass and low pass outputs
+    for the sample before x, zero if omitted. It is updated so that the
+    next block can be filtered.
+
+    """
+    # The band pass and low pass outputs are the state s of a linear
+    # system s[n] = A s[n-1] + B x[n]. Within a block of N samples, the
+    # band pass output is the convolution of x with the impulse response
+    # of the system, computed for all blocks at once with FFTs, and the
+    # low pass output is its running sum, since l[n] = F b[n] + l[n-1].
+    # The response to the state before each block, A ** (k+1) s, is
+    # added afterwards. Only the states between blocks are computed in
+    # turn.
     F = 2 * numpy.sin(numpy.pi * f / samplerate)
     Q = 2 * damping
+    A = numpy.array([[1 - F * Q, -F], [F * (1 - F * Q), 1 - F * F]])
+    B = numpy.array([F, F * F])
 
-    yh = numpy.zeros(len(x))
-    yb = numpy.zeros(len(x))
-    yl = numpy.zeros(len(x))
-    for n in range(len(x)):
-        yh[n] = x[n] - yl[n-1] - Q * yb[n-1]
-        yb[n] = F * yh[n] + yb[n-1]
-        yl[n] = F * yb[n] + yl[n-1]
+    x = numpy.asarray(x, dtype='float64')
+    l = len(x)
+    s0 = numpy.zeros(2) if state is None else numpy.array(state)
+    N = SVF_BLOCKSIZE
+    numblocks = max(1, -(-l // N))
+    P = _powers(A, N + 1)
+    blocks = numpy.zeros(numblocks * N)
+    blocks[:l] = x
+    blocks = blocks.reshape(numblocks, N)
+
+    # Zero-state response of each block.
+    g = numpy.dot(P[:N], B)[:, 0]
+    X = numpy.fft.rfft(blocks, 2 * N)
+    X *= numpy.fft.rfft(g, 2 * N)
+    yb = numpy.fft.irfft(X, 2 * N)[:, :N]
+    yl = F * numpy.cumsum(yb, axis=1)
+
+    # States before each block.
+    starts = numpy.empty((numblocks, 2))
+    start = s0
+    for i in range(numblocks):
+        starts[i] = start
+        start = numpy.dot(P[N], start) + (yb[i, -1], yl[i, -1])
+
+    response = numpy.dot(starts, P[1:].transpose(2, 1, 0).reshape(2, -1))
+    response = response.reshape(numblocks, 2, N)
+    yb += response[:, 0, :]
+    yl += response[:, 1, :]
+    yb = yb.ravel()[:l]
+    yl = yl.ravel()[:l]
+    yh = x - numpy.concatenate(([s0[1]], yl[:-1])) \
+           - Q * numpy.concatenate(([s0[0]], yb[:-1]))
+    if state is not None and l:
+        state[:] = yb[-1], yl[-1]
     return yh, yb, yl
 
+def svf_frames(x, f, damping, samplerate, output=2, state=None):
+    """Filter a block of frames and return one response.
+
+    x has one column per channel, or is 1-D for a single channel.
+    output is an index in the tuple returned by svf(). state is a
+    float64 array of shape (channels, 2), updated so that the next
+    block can be filtered.
+
+    """
+    channels = [x] if x.ndim == 1 else x.transpose()
+    if state is None:
+        state = numpy.zeros((len(channels), 2))
+    y = []
+    for channel, s in zip(channels, state):
+        y.append(svf(channel, f, damping, samplerate, s)[output])
+    if x.ndim == 1:
+        return y[0]
+    return numpy.array(y).transpose()
+
+numpy_svf = svf
+numpy_svf_frames = svf_frames
+
 try:
-    from _svf import svf
+    from _svf import svf, svf_frames
 except ImportError:
     print ("Warning: Optimized implementation of state variable filters not "
-           "found, using pure python implementation instead.")
-
-def process_each_channel(func, x):
-    ndim = x.ndim
-    if ndim == 1:
-        x = [x]
-    else:
-        x = x.transpose()
-    y = []
-    for channel in x:
-        y.append(func(channel))
-    if ndim == 1:
-        y = y[0]
-    else:
-        y = numpy.array(y).transpose()
-    return y
+           "found, using numpy implementation instead.")
 
 
-def svf_fx(type, sound, start, end):
+class SVF(Processor):
+    """Filter blocks of frames, keeping the filter state of each
+    channel from one block to the next. Channels are filtered in
+    parallel."""
 
-    def process(freq, damp):
-        def apply(channel):
-            filtered = svf(channel, freq, damp, sound.samplerate)
-            i = svf_index[type]
-            return filtered[i]
-        y = process_each_channel(apply, sound.frames[start:end])
-        sound.paste(start, end, y)
+    preserves_length = True
 
-    def callback(parameters):
+    def __init__(self, type, f, damping, samplerate):
+        self._index = svf_index[type]
+        self._args = (f, damping, samplerate)
+        self._state = None
+
+    def process(self, block):
+        block = numpy.asarray(block, dtype='float64')
+        if self._state is None:
+            channels = 1 if block.ndim == 1 else block.shape[1]
+            self._state = numpy.zeros((channels, 2))
+        if block.ndim == 1:
+            return svf_frames(block, *self._args, output=self._index,
+                              state=self._state)
+
+        def filter(c):
+            return svf_frames(block[:, c], *self._args, output=self._index,
+                              state=self._state[c:c + 1])
+
+        return numpy.array(parallel.map(filter, range(block.shape[1]))).T
+
+
+def svf_fx(type, sound, start, end):
+
+    def processor(parameters):
         freq = parameters['Frequency']
         damp = parameters['Damping']
-        process(freq, damp)
+        return SVF(type, freq, damp, sound.samplerate)
+
+    def callback(parameters):
+        stream(sound, start, end, processor(parameters))
 
     d = EffectDialog(type + ' State Variable Filter')
     d.add_slider('Frequency', 500, 0, 5000)
     d.add_slider('Damping', 0.5, 0.01, 3, 1)
     d.callback = callback
+    d.processor = processor
     return d
 
 
 effects['Filter: High Pass'] = functools.partial(svf_fx, "High Pass")
 effects['Filter: Band Pass'] = functools.partial(svf_fx, "Band Pass")
 effects['Filter: Low Pass'] = functools.partial(svf_fx, "Low Pass")
+
+
+# Tests
+if __name__ == '__main__':
+    def reference(x, f, damping, samplerate):
+        F = 2 * numpy.sin(numpy.pi * f / samplerate)
+        Q = 2 * damping
+        yh = numpy.zeros(len(x))
+        yb = numpy.zeros(len(x))
+        yl = numpy.zeros(len(x))
+        for n in range(len(x)):
+            yh[n] = x[n] - yl[n-1] - Q * yb[n-1]
+            yb[n] = F * yh[n] + yb[n-1]
+            yl[n] = F * yb[n] + yl[n-1]
+        return yh, yb, yl
+
+    x = numpy.random.uniform(-1, 1, 5000)
+    for f, damping in [(500, 0.5), (20, 0.01), (5000, 1)]:
+        ref = reference(x, f, damping, 44100)
+        for filter in [numpy_svf, svf]:
+            y = filter(x, f, damping, 44100)
+            for a, b in zip(y, ref):
+                assert numpy.allclose(a, b, atol=1e-6)
+
+    # Filtering block by block gives the same result.
+    # Only the requested response of each channel is computed.
+    x2 = numpy.random.uniform(-1, 1, (3000, 2))
+    for filter in [numpy_svf_frames, svf_frames]:
+        for index in range(3):
+            y = filter(x2, 500, 0.5, 44100, index)
+            assert y.shape == x2.shape
+            for c in range(2):
+                ref = reference(x2[:, c], 500, 0.5, 44100)[index]
+                assert numpy.allclose(y[:, c], ref, atol=1e-6)
+        assert numpy.allclose(filter(x2[:, 0], 500, 0.5, 44100, 1),
+                              reference(x2[:, 0], 500, 0.5, 44100)[1])
+        state = numpy.zeros((2, 2))
+        y1 = filter(x2[:1000], 500, 0.5, 44100, 2, state)
+        y2 = filter(x2[1000:], 500, 0.5, 44100, 2, state)
+        assert numpy.allclose(numpy.concatenate((y1, y2)),
+                              filter(x2, 500, 0.5, 44100, 2))
+
+    for filter in [numpy_svf, svf]:
+        state = numpy.zeros(2)
+        y1 = filter(x[:1234], 500, 0.5, 44100, state)
+        y2 = filter(x[1234:], 500, 0.5, 44100, state)
+        y = filter(x, 500, 0.5, 44100)
+        for a, b, c in zip(y1, y2, y):
+            assert numpy.allclose(numpy.concatenate((a, b)), c)
+        assert len(filter(x[:0], 500, 0.5, 44100)[0]) == 0
+
+    # Frames of a sound may be read-only.
+    for frames in [x, x2]:
+        frames = frames.copy()
+        frames.flags.writeable = False
+        for filter in [numpy_svf_frames, svf_frames]:
+            y = filter(frames, 500, 0.5, 44100)
+            assert y.shape == frames.shape
+        assert SVF("Low Pass", 500, 0.5, 44100).process(frames).shape == \
+               frames.shape
+    frames = x.copy()
+    frames.flags.writeable = False
+    for filter in [numpy_svf, svf]:
+        assert numpy.allclose(filter(frames, 500, 0.5, 44100)[2],
+                              reference(x, 500, 0.5, 44100)[2], atol=1e-6)
@@ -5,22 +5,20 @@ volume_last = 100
 
 def volume(sound, start, end):
 
-    def process(volume):
-        gain = volume / 100.
-        x = sound.frames[start:end]
-        y = x * gain
-        sound.paste(start, end, y)
+    def processor(parameters):
+        gain = parameters['Volume'] / 100.
+        return effect.Map(lambda x: x * gain)
 
     def callback(parameters):
         global volume_last
-        volume = parameters['Volume']
-        volume_last = volume
-        process(volume)
+        volume_last = parameters['Volume']
+        effect.transform_gain(sound, start, end, volume_last / 100.)
 
     global volume_last
     d = EffectDialog('Volume')
     d.add_slider('Volume', volume_last, 0, 200, 0)
     d.callback = callback
+    d.processor = processor
     return d
 
 effect.effects['Volume'] = volume
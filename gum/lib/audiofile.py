@@ -1,22 +1,276 @@
 # Simple interface for reading and writing sound files in a variety of formats.
-# Uses pysndfile if possible; falls back to ffmpeg if necessary.
+# Uncompressed WAV, RF64 and AIFF files are memory-mapped and decoded on
+# demand. Other files are read with pysndfile if possible; falls back to
+# ffmpeg if necessary, which streams decoded frames through a pipe.
 
+from gum.lib.event import Signal
+from gum.lib import pieces
 import pysndfile
+import numpy
 from collections import namedtuple
 import warnings
-import os, subprocess, tempfile
+import threading
+import os, subprocess, tempfile, struct
+import json
+from distutils.spawn import find_executable
 
 
 AudioFile = namedtuple('AudioFile', 'data samplerate format')
 
+# Storage modes, for the dtype argument of read():
+#
+#   'float64'  frames are float64, as pysndfile returns them.
+#   'float32'  frames are float32.
+#   'native'   integer PCM files keep their int16 or int32 samples, which
+#              are converted to float64 when sliced. Writing them back
+#              to a file does not requantize them.
+#
+# Objects that hold integer samples have a pcm(start, end) method that
+# returns them.
+DTYPES = ('float64', 'float32', 'native')
 
-def _read_pysndfile(filename):
+
+class PCMFrames(object):
+    """Integer PCM frames, converted to float64 when sliced."""
+
+    def __init__(self, samples):
+        self._samples = samples
+        self._scale = 1. / 2 ** (8 * samples.itemsize - 1)
+
+    def __len__(self):
+        return len(self._samples)
+
+    @property
+    def ndim(self):
+        return self._samples.ndim
+
+    def __getitem__(self, key):
+        return self._samples[key] * self._scale
+
+    def pcm(self, start, end):
+        return self._samples[start:end]
+
+
+def _read_pysndfile(filename, dtype='float64'):
     f = pysndfile.PySndfile(filename)
     nframes = f.frames()
-    data = f.read_frames(nframes)
+    if dtype == 'native':
+        encoding = f.encoding_str()
+        if encoding in ('pcms8', 'pcmu8', 'pcm16'):
+            data = PCMFrames(f.read_frames(nframes, dtype=numpy.int16))
+        elif encoding in ('pcm24', 'pcm32'):
+            data = PCMFrames(f.read_frames(nframes, dtype=numpy.int32))
+        elif encoding == 'float64':
+            data = f.read_frames(nframes)
+        else:
+            data = f.read_frames(nframes, dtype=numpy.float32)
+    else:
+        data = f.read_frames(nframes, dtype=numpy.dtype(dtype))
     return AudioFile(data, f.samplerate(), f.format())
 
 
+class MappedFrames(object):
+    """Frames of an uncompressed sound file, decoded on demand.
+
+    The sample data is memory-mapped; slicing returns float frames of
+    the given dtype, scaled like pysndfile does. Mono sounds are
+    one-dimensional.
+
+    """
+
+    def __init__(self, filename, offset, nframes, channels, width,
+                 byteorder='<', floating=False, unsigned=False,
+                 dtype='float64'):
+        self.channels = channels
+        self._dtype = numpy.dtype(dtype)
+        self._width = width
+        self._byteorder = byteorder
+        if width == 3:
+            dtype = numpy.uint8
+            shape = (nframes, channels, 3)
+        else:
+            kind = 'f' if floating else ('u' if unsigned else 'i')
+            dtype = numpy.dtype(byteorder + kind + str(width))
+            shape = (nframes, channels)
+        self._map = numpy.memmap(filename, dtype=dtype, mode='r',
+                                 offset=offset, shape=shape)
+        self._floating = floating
+        self._unsigned = unsigned
+
+    def __len__(self):
+        return len(self._map)
+
+    @property
+    def ndim(self):
+        return 1 if self.channels == 1 else 2
+
+    def _decode(self, raw):
+        if self._floating:
+            y = raw.astype(self._dtype)
+        else:
+            y = self._integers(raw).astype(self._dtype)
+            y *= 1. / 2 ** 31
+        if self.channels == 1:
+            y = y[:, 0]
+        return y
+
+    def _integers(self, raw):
+        # Return samples as left-justified int32 values.
+        if self._width == 3:
+            b = raw.astype(numpy.int32)
+            if self._byteorder == '>':
+                b = b[..., ::-1]
+            return (b[..., 0] << 8) | (b[..., 1] << 16) | (b[..., 2] << 24)
+        elif self._unsigned:
+            return (raw.astype(numpy.int32) - 128) << 24
+        else:
+            x = raw.astype(numpy.int32)
+            return x << (32 - 8 * self._width)
+
+    def __getitem__(self, key):
+        return self._decode(self._map[key])
+
+    def pcm(self, start, end):
+        if self._floating:
+            return None
+        raw = self._map[start:end]
+        if self._width == 2 and not self._unsigned:
+            x = raw.astype(numpy.int16)
+        else:
+            x = self._integers(raw)
+        if self.channels == 1:
+            x = x[:, 0]
+        return x
+
+
+def _chunks(f, endian, end):
+    """Yield (id, offset, size) for each chunk of a RIFF or IFF file."""
+    pos = f.tell()
+    while pos + 8 <= end:
+        f.seek(pos)
+        cid, size = struct.unpack(endian + '4sI', f.read(8))
+        yield cid, pos + 8, size
+        pos = pos + 8 + size + (size & 1)
+
+
+def _map_wav(f, filename, filesize, dtype):
+    riff, size, wave = struct.unpack('<4sI4s', f.read(12))
+    if riff not in ('RIFF', 'RF64') or wave != 'WAVE':
+        return None
+    fmt = None
+    data_size = None
+    for cid, offset, size in _chunks(f, '<', filesize):
+        f.seek(offset)
+        if cid == 'ds64':
+            riff_size, data_size = struct.unpack('<QQ', f.read(16))
+        elif cid == 'fmt ':
+            fmt = f.read(size)
+        elif cid == 'data':
+            if size != 0xFFFFFFFF or data_size is None:
+                data_size = size
+            break
+    else:
+        return None
+    if fmt is None:
+        return None
+    tag, channels, samplerate, _, block, bits = struct.unpack('<HHIIHH',
+                                                              fmt[:16])
+    extensible = tag == 0xFFFE
+    if extensible:
+        tag, = struct.unpack('<H', fmt[24:26])
+    width = block // channels
+    if tag == 1 and width in (1, 2, 3, 4):
+        encoding = {1: 'pcmu8', 2: 'pcm16', 3: 'pcm24', 4: 'pcm32'}[width]
+        floating = False
+    elif tag == 3 and width in (4, 8):
+        encoding = 'float%d' % (8 * width)
+        floating = True
+    else:
+        return None
+    if riff == 'RF64':
+        major = 'rf64'
+    elif extensible:
+        major = 'wavex'
+    else:
+        major = 'wav'
+    nframes = min(data_size, filesize - offset) // block
+    if not nframes:
+        return None
+    data = MappedFrames(filename, offset, nframes, channels, width,
+                        floating=floating, unsigned=width == 1, dtype=dtype)
+    format = pysndfile.construct_format(major, encoding)
+    return AudioFile(data, samplerate, format)
+
+
+def _extended(b):
+    """Convert an 80-bit IEEE 754 extended float to a python number."""
+    exponent, mantissa = struct.unpack('>HQ', b)
+    sign = -1 if exponent & 0x8000 else 1
+    exponent = (exponent & 0x7FFF) - 16383 - 63
+    return sign * mantissa * 2.0 ** exponent
+
+
+def _map_aiff(f, filename, filesize, dtype):
+    form, size, kind = struct.unpack('>4sI4s', f.read(12))
+    if form != 'FORM' or kind not in ('AIFF', 'AIFC'):
+        return None
+    comm = None
+    ssnd = None
+    for cid, offset, size in _chunks(f, '>', filesize):
+        f.seek(offset)
+        if cid == 'COMM':
+            comm = f.read(size)
+        elif cid == 'SSND':
+            skip, = struct.unpack('>I', f.read(4))
+            ssnd = offset + 8 + skip
+    if comm is None or ssnd is None:
+        return None
+    channels, nframes, bits = struct.unpack('>hIh', comm[:8])
+    samplerate = int(_extended(comm[8:18]))
+    compression = comm[18:22] if kind == 'AIFC' else 'NONE'
+    byteorder = '>'
+    floating = False
+    width = (bits + 7) // 8
+    if compression == 'sowt':
+        byteorder = '<'
+    elif compression in ('fl32', 'FL32'):
+        floating, width = True, 4
+    elif compression in ('fl64', 'FL64'):
+        floating, width = True, 8
+    elif compression != 'NONE':
+        return None
+    if width not in ((4, 8) if floating else (1, 2, 3, 4)):
+        return None
+    if floating:
+        encoding = 'float%d' % (8 * width)
+    else:
+        encoding = {1: 'pcms8', 2: 'pcm16', 3: 'pcm24', 4: 'pcm32'}[width]
+    nframes = min(nframes, (filesize - ssnd) // (width * channels))
+    if not nframes:
+        return None
+    data = MappedFrames(filename, ssnd, nframes, channels, width,
+                        byteorder=byteorder, floating=floating, dtype=dtype)
+    format = pysndfile.construct_format('aiff', encoding)
+    return AudioFile(data, samplerate, format)
+
+
+def _read_mmap(filename, dtype='float64'):
+    # Return None if the file is not an uncompressed WAV, RF64 or AIFF file.
+    if dtype == 'native':
+        dtype = 'float64'
+    try:
+        filesize = os.path.getsize(filename)
+        with open(filename, 'rb') as f:
+            for parse in (_map_wav, _map_aiff):
+                f.seek(0)
+                contents = parse(f, filename, filesize, dtype)
+                if contents is not None:
+                    return contents
+    except (IOError, OSError, ValueError, struct.error):
+        pass
+    return None
+
+
 def _popen(cmd):
     pipe = subprocess.PIPE
     return subprocess.Popen(cmd, stdin=pipe, stdout=pipe, stderr=pipe)
@@ -24,59 +278,507 @@ def _popen(cmd):
 
 def _has_ffmpeg():
     # try to run ffmpeg -version and see if we get a sane result.
+    if find_executable('ffmpeg') is None:
+        return False
     proc = _popen(['ffmpeg', '-version'])
     proc.communicate()
     return 0 == proc.returncode
 
 
-def _read_ffmpeg(filename):
-    # use ffmpeg to convert the input file to a temporary wav file we can read
+def _read_header(stream):
+    # Read a WAV header from a stream, up to the start of the data
+    # chunk. Return (channels, samplerate).
+    riff = stream.read(12)
+    if len(riff) < 12 or riff[:4] != 'RIFF' or riff[8:] != 'WAVE':
+        raise IOError("ffmpeg could not decode the file")
+    channels = None
+    while True:
+        header = stream.read(8)
+        if len(header) < 8:
+            raise IOError("Truncated WAV stream")
+        ckid, size = struct.unpack('<4sI', header)
+        if ckid == 'data':
+            break
+        body = stream.read(size + (size & 1))
+        if ckid == 'fmt ':
+            _, channels, samplerate = struct.unpack('<HHI', body[:8])
+    if channels is None:
+        raise IOError("No format chunk in WAV stream")
+    return channels, samplerate
+
+
+class Decoder(threading.Thread):
+    """Decode a sound file with ffmpeg, which streams PCM through a pipe.
+
+    The samplerate and the number of channels are known once the
+    object is built. When the thread is started, the decoded signal is
+    called with each block of frames as it arrives, and the finished
+    signal with the exception that stopped the decoder (Cancelled if
+    it was closed), or None. Both are called from the decoder thread.
+
+    """
+
+    def __init__(self, filename, dtype='float64'):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        # Compressed files have no native integer samples.
+        if dtype == 'float64':
+            codec, self._dtype = 'pcm_f64le', numpy.dtype('<f8')
+        else:
+            codec, self._dtype = 'pcm_f32le', numpy.dtype('<f4')
+        self._proc = _popen(['ffmpeg', '-nostdin', '-v', '1', '-i', filename,
+                             '-vn', '-f', 'wav', '-acodec', codec, '-'])
+        self._closed = threading.Event()
+        try:
+            self.channels, self.samplerate = _read_header(self._proc.stdout)
+        except:
+            self.close()
+            raise
+        if self.channels == 1:
+            self.empty = numpy.zeros(0, self._dtype)
+        else:
+            self.empty = numpy.zeros((0, self.channels), self._dtype)
+        self.decoded = Signal()
+        self.finished = Signal()
+        self.error = None
+
+    def blocks(self):
+        """Yield the decoded frames in blocks of at most BLOCKSIZE
+        frames, as ffmpeg delivers them."""
+        framesize = self.channels * self._dtype.itemsize
+        while True:
+            raw = self._proc.stdout.read(BLOCKSIZE * framesize)
+            raw = raw[:len(raw) - len(raw) % framesize]
+            if not raw:
+                break
+            block = numpy.frombuffer(raw, self._dtype)
+            if self.channels > 1:
+                block = block.reshape(-1, self.channels)
+            yield block
+        self._proc.communicate()
+        if self._closed.isSet():
+            raise Cancelled()
+        if self._proc.returncode:
+            raise IOError("ffmpeg failed to decode the file")
+
+    def run(self):
+        try:
+            for block in self.blocks():
+                self.decoded(block)
+        except Exception, e:
+            self.error = e
+        self.finished(self.error)
+
+    def close(self):
+        """Stop decoding."""
+        self._closed.set()
+        if self._proc.poll() is None:
+            self._proc.kill()
+
+
+def _read_ffmpeg(filename, dtype='float64', background=False):
+    # ffmpeg decodes the input file to a WAV stream that is read from a
+    # pipe, block by block. In the background, the Decoder is returned
+    # unstarted as the data.
     try:
-        tempfd, temppath = tempfile.mkstemp(suffix='.wav')
-        proc = _popen(['ffmpeg','-v','1','-y','-i', filename, temppath])
-        proc.communicate()
-        if proc.returncode: return None
-        return _read_pysndfile(temppath)
-    finally:
-        os.close(tempfd)
-        os.remove(temppath)
+        decoder = Decoder(filename, dtype)
+    except (IOError, OSError):
+        return None
+    format = pysndfile.construct_format('wav', 'pcm16')
+    if background:
+        return AudioFile(decoder, decoder.samplerate, format)
+    data = pieces.Pieces.join(list(decoder.blocks()), decoder.empty)
+    return AudioFile(data, decoder.samplerate, format)
+
+
+# The result of probing the supported formats is cached on disk, keyed
+# by the paths and modification times of ffmpeg and of the pysndfile
+# extension, and by the libsndfile version.
+CACHE_DIR = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'gum')
+_formats_cache = os.path.join(CACHE_DIR, 'formats.json')
+
+
+def _stat(path):
+    if path is None or not os.path.exists(path):
+        return None
+    return [os.path.abspath(path), os.path.getmtime(path)]
+
+
+def _probe_key():
+    # Must not launch any process.
+    return {'ffmpeg': _stat(find_executable('ffmpeg')),
+            'pysndfile': _stat(pysndfile.__file__),
+            'libsndfile': pysndfile.get_sndfile_version()}
+
+
+def _probe():
+    with warnings.catch_warnings():
+        # pysndfile likes to complain about formats that libsndfile
+        # supports, but which haven't been added to pysndfile itself yet;
+        # we really don't care and would rather not be pestered about it.
+        warnings.simplefilter('ignore')
+        extensions = list(pysndfile.get_sndfile_formats())
+    if _has_ffmpeg():
+        extensions.append('mp3')
+    return extensions
+
+
+def _load_probe(key):
+    # Return the cached extensions, or None if the cache is stale.
+    try:
+        with open(_formats_cache) as f:
+            cache = json.load(f)
+        if cache['key'] != json.loads(json.dumps(key)):
+            return None
+        return [str(ext) for ext in cache['extensions']]
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _save_probe(key, extensions):
+    directory = os.path.dirname(_formats_cache)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        tempfd, temppath = tempfile.mkstemp(dir=directory, suffix='.json')
+        with os.fdopen(tempfd, 'w') as f:
+            json.dump({'key': key, 'extensions': extensions}, f)
+        os.rename(temppath, _formats_cache)
+    except (IOError, OSError):
+        pass
 
 
 # This will be populated by the first call to list_extensions().
 _supported_extensions = None
+_probe_lock = threading.Lock()
+
 def list_extensions():
     global _supported_extensions
-    if _supported_extensions is None:
-        with warnings.catch_warnings():
-            # pysndfile likes to complain about formats that libsndfile
-            # supports, but which haven't been added to pysndfile itself yet;
-            # we really don't care and would rather not be pestered about it.
-            warnings.simplefilter('ignore')
-            _supported_extensions = pysndfile.get_sndfile_formats()
-        if _has_ffmpeg():
-            _supported_extensions.append('mp3')
+    with _probe_lock:
+        if _supported_extensions is None:
+            key = _probe_key()
+            extensions = _load_probe(key)
+            if extensions is None:
+                extensions = _probe()
+                _save_probe(key, extensions)
+            _supported_extensions = extensions
     return _supported_extensions
 
 
-def read(filename):
-    # Try to read the file with pysndfile. If it fails, try ffmpeg.
+def probe_extensions():
+    """Populate list_extensions() in a background thread, which is
+    returned. If the cache on disk is stale, formats are probed by
+    the thread."""
+    thread = threading.Thread(target=list_extensions)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def read(filename, dtype='float64', background=False):
+    # Try to memory-map the file. Otherwise, try to read the file with
+    # pysndfile. If it fails, try ffmpeg. dtype is one of DTYPES. If
+    # background is True and ffmpeg is used, the data is a Decoder that
+    # must be started to deliver the frames.
+    if dtype not in DTYPES:
+        raise ValueError("Unknown storage mode: %s" % dtype)
+    f = _read_mmap(filename, dtype)
+    if f is not None:
+        return f
     try:
-        return _read_pysndfile(filename)
+        return _read_pysndfile(filename, dtype)
     except IOError:
-        f = _read_ffmpeg(filename)
+        f = _read_ffmpeg(filename, dtype, background)
         if f is None: raise
         return f
 
 
-def write(filename, contents):
-    channels = contents.data.ndim
-    format = contents.format
-    f = pysndfile.PySndfile(
-        filename,
-        mode='w',
-        format=format,
-        channels=contents.data.ndim,
-        samplerate=contents.samplerate
-    )
-    f.write_frames(contents.data)
+# Number of frames passed to pysndfile at once when writing.
+BLOCKSIZE = 65536
+
+def _blocks(data, blocksize=None):
+    """Yield the frames of data in blocks.
+
+    data is an array, a frames object or a Pieces object. Integer PCM
+    samples are yielded as is when available, so that they are written
+    without being requantized.
+
+    """
+    if blocksize is None:
+        blocksize = BLOCKSIZE
+    if hasattr(data, 'spans'):
+        spans = data.spans()
+    else:
+        spans = [(data, 0, len(data))]
+    for buffer, offset, length in spans:
+        for start in range(offset, offset + length, blocksize):
+            end = min(start + blocksize, offset + length)
+            block = None
+            if hasattr(buffer, 'pcm'):
+                block = buffer.pcm(start, end)
+            if block is None:
+                block = buffer[start:end]
+            yield numpy.ascontiguousarray(block)
+
+
+def _numchannels(data):
+    if data.ndim == 1:
+        return 1
+    return data[0:0].shape[1]
+
+
+def write(filename, contents, callback=None):
+    # Write to a temporary file that replaces the destination when done:
+    # the destination may be memory-mapped by a MappedFrames object.
+    # callback is called with the number of frames written after each
+    # block; it may raise an exception to abort.
+    directory, name = os.path.split(os.path.abspath(filename))
+    tempfd, temppath = tempfile.mkstemp(dir=directory, prefix='.' + name)
+    os.close(tempfd)
+    try:
+        format = contents.format
+        f = pysndfile.PySndfile(
+            temppath,
+            mode='w',
+            format=format,
+            channels=_numchannels(contents.data),
+            samplerate=contents.samplerate
+        )
+        written = 0
+        for block in _blocks(contents.data):
+            f.write_frames(block)
+            written += len(block)
+            if callback is not None:
+                callback(written)
+        del f
+        if os.path.exists(filename):
+            mode = os.stat(filename).st_mode
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0666 & ~umask
+        os.chmod(temppath, mode & 0777)
+        os.rename(temppath, filename)
+    except:
+        os.remove(temppath)
+        raise
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Writer(threading.Thread):
+    """Write a sound file in a background thread.
+
+    contents.data must not change while it is written, which is the
+    case of a Pieces object. The progress signal is called with the
+    fraction of frames written. The finished signal is called with
+    the exception that stopped the writer (Cancelled if it was
+    cancelled), or None. Both are called from the writer thread.
+
+    """
+
+    def __init__(self, filename, contents):
+        threading.Thread.__init__(self)
+        self.filename = filename
+        self._contents = contents
+        self._total = len(contents.data)
+        self._cancel = threading.Event()
+        self.progress = Signal()
+        self.finished = Signal()
+        self.error = None
+
+    def run(self):
+        try:
+            write(self.filename, self._contents, self._report)
+        except Exception, e:
+            self.error = e
+        self.finished(self.error)
+
+    def _report(self, written):
+        self.progress(float(written) / self._total)
+        if self._cancel.isSet():
+            raise Cancelled()
+
+    def cancel(self):
+        """Stop writing. The destination file is left untouched."""
+        self._cancel.set()
+
+
+if __name__ == '__main__':
+    import gum
+
+    def test_read_mmap():
+        # Mapped files decode to the same frames as pysndfile.
+        for name in ['test1.wav', 'test2.wav', 'test3.wav']:
+            filename = os.path.join(gum.testdir, name)
+            mapped = _read_mmap(filename)
+            decoded = _read_pysndfile(filename)
+            assert mapped.samplerate == decoded.samplerate
+            assert mapped.format == decoded.format
+            assert mapped.data[:].shape == decoded.data.shape
+            assert (mapped.data[:] == decoded.data).all()
+            assert (mapped.data[100:200] == decoded.data[100:200]).all()
+
+        # Not a sound file
+        assert _read_mmap(gum.logofile) is None
+        assert _read_mmap('/nonexistent.wav') is None
+
+    def test_map_aiff():
+        # 64-bit integer samples are left to the decoder.
+        from StringIO import StringIO
+        rate = struct.pack('>HQ', 16383 + 15, 44100 << 48)
+        comm = struct.pack('>hIh', 1, 4, 64) + rate
+        ssnd = struct.pack('>II', 0, 0) + '\0' * 32
+        chunks = ('COMM' + struct.pack('>I', len(comm)) + comm
+                  + 'SSND' + struct.pack('>I', len(ssnd)) + ssnd)
+        data = 'FORM' + struct.pack('>I', len(chunks) + 4) + 'AIFF' + chunks
+        assert _extended(rate) == 44100
+        assert _map_aiff(StringIO(data), 'test.aiff', len(data),
+                         'float64') is None
+
+    def test_native():
+        # Integer samples are kept and written back as is.
+        for name in ['test1.wav', 'test2.wav', 'test3.wav']:
+            filename = os.path.join(gum.testdir, name)
+            contents = read(filename, 'native')
+            decoded = _read_pysndfile(filename, 'native').data
+            ref = _read_pysndfile(filename).data
+            assert (contents.data[:] == ref).all()
+            assert (decoded[:] == ref).all()
+            assert (contents.data.pcm(0, 10) == decoded.pcm(0, 10)).all()
+            outfile = '/tmp/test_native.wav'
+            write(outfile, contents)
+            f = pysndfile.PySndfile(outfile)
+            assert f.format() == contents.format
+            assert (f.read_frames(f.frames(), dtype=numpy.int32) ==
+                    pysndfile.PySndfile(filename).read_frames(
+                        dtype=numpy.int32)).all()
+            os.remove(outfile)
+
+        contents = read(os.path.join(gum.testdir, 'test2.wav'), 'float32')
+        assert contents.data[:].dtype == numpy.float32
+
+    def test_write():
+        # Writing over a memory-mapped file does not invalidate it.
+        import shutil
+        filename = '/tmp/test_mmap.wav'
+        shutil.copy(os.path.join(gum.testdir, 'test2.wav'), filename)
+        contents = read(filename)
+        frames = contents.data[:]
+        write(filename, AudioFile(frames[::-1], contents.samplerate,
+                                  contents.format))
+        assert (contents.data[:] == frames).all()
+        assert (read(filename).data[:] == frames[::-1]).all()
+        os.remove(filename)
+
+    def test_writer():
+        filename = '/tmp/test_writer.wav'
+        contents = read(os.path.join(gum.testdir, 'test2.wav'))
+        global BLOCKSIZE
+        BLOCKSIZE = 1000
+        progress = []
+        finished = []
+        def on_progress(fraction):
+            progress.append(fraction)
+        def on_finished(error):
+            finished.append(error)
+        writer = Writer(filename, contents)
+        writer.progress.connect(on_progress)
+        writer.finished.connect(on_finished)
+        writer.start()
+        writer.join()
+        assert finished == [None]
+        assert progress[-1] == 1.0 and len(progress) > 1
+        assert (read(filename).data[:] == contents.data[:]).all()
+
+        # cancel: the destination is left untouched.
+        def cancel(fraction):
+            writer.cancel()
+        writer = Writer(filename, AudioFile(contents.data[:100],
+                                            contents.samplerate,
+                                            contents.format))
+        writer.progress.connect(cancel)
+        writer.start()
+        writer.join()
+        assert isinstance(writer.error, Cancelled)
+        assert len(read(filename).data) == len(contents.data)
+        os.remove(filename)
+
+    def test_read_header():
+        from StringIO import StringIO
+        fmt = struct.pack('<HHIIHH', 3, 2, 48000, 384000, 8, 32)
+        stream = StringIO('RIFF\xff\xff\xff\xffWAVE'
+                          + 'fmt ' + struct.pack('<I', len(fmt)) + fmt
+                          + 'LIST' + struct.pack('<I', 3) + 'abc\0'
+                          + 'data\xff\xff\xff\xff' + 'frames')
+        assert _read_header(stream) == (2, 48000)
+        assert stream.read() == 'frames'
+        try:
+            _read_header(StringIO(''))
+        except IOError:
+            pass
+        else:
+            assert False
+
+    def test_ffmpeg():
+        # Frames are decoded from the pipe block by block.
+        filename = os.path.join(gum.testdir, 'test2.wav')
+        ref = _read_pysndfile(filename).data
+        contents = _read_ffmpeg(filename)
+        assert len(contents.data.spans()) > 1
+        assert (contents.data[:] == ref).all()
+        assert _read_ffmpeg(gum.logofile) is None
+
+        decoder = _read_ffmpeg(filename, 'float32', background=True).data
+        blocks = []
+        finished = []
+        def on_decoded(block):
+            blocks.append(block)
+        def on_finished(error):
+            finished.append(error)
+        decoder.decoded.connect(on_decoded)
+        decoder.finished.connect(on_finished)
+        decoder.start()
+        decoder.join()
+        assert finished == [None]
+        assert decoder.samplerate == contents.samplerate
+        frames = numpy.concatenate(blocks)
+        assert frames.dtype == numpy.float32
+        assert (frames == ref.astype(numpy.float32)).all()
+
+    def test_probe_cache():
+        global _formats_cache, _supported_extensions, _probe
+        _formats_cache = '/tmp/test_gum_cache/formats.json'
+        key = _probe_key()
+        assert _load_probe(key) is None
+        extensions = list_extensions()
+        assert _load_probe(key) == extensions
+
+        # The cache is used instead of probing.
+        def probe():
+            assert False
+        _probe, probe = probe, _probe
+        _supported_extensions = None
+        probe_extensions().join()
+        assert list_extensions() == extensions
+
+        # A stale cache is probed again.
+        key['libsndfile'] = 'other'
+        assert _load_probe(key) is None
+        _probe = probe
+        import shutil
+        shutil.rmtree('/tmp/test_gum_cache')
+
+    test_read_mmap()
+    test_map_aiff()
+    test_native()
+    test_write()
+    test_writer()
+    test_read_header()
+    test_probe_cache()
+    if _has_ffmpeg():
+        test_ffmpeg()
 
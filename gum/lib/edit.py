@@ -1,18 +1,28 @@
 import numpy
-import samplerate
 
 
 def resample(frames, ratio):
+    import samplerate
     new = samplerate.resample(frames, ratio, 'sinc_best')
     return numpy.array(new, dtype='float64')
 
 
+def _numchan(frames):
+    """Return the number of channels of frames, which have one column
+    per channel, or are one-dimensional for a single channel."""
+    if frames.ndim == 1:
+        return 1
+    return frames.shape[1]
+
+
 def mix_channels(frames, gain_lists):
     """Mix channels into a possibly different number of channels.
 
     * len(gain_lists) defines the number of output channels,
     * gain_lists[n] contains gains to mix input channels into output
-      channel number n. Consequently, len(gain_lists[n]) == frames.ndim.
+      channel number n. Consequently, len(gain_lists[n]) is the number
+      of channels of frames: frames.shape[1], or 1 if frames is
+      one-dimensional.
     
     Returns the mixed signal.
 
@@ -25,30 +35,21 @@ def mix_channels(frames, gain_lists):
           mix_channels(frames, [[0.5, 0.5]])
 
     """
-    numchan = frames.ndim
+    numchan = _numchan(frames)
     assert len(gain_lists[0]) == numchan
 
+    # One row of gains per output channel, one column per input channel.
+    gains = numpy.array(gain_lists, dtype='float64')
+
     # special case for monophonic sounds
-    if numchan == 1:
-        channels = [frames]
-    else:
-        channels = frames.transpose()
+    if frames.ndim == 1:
+        frames = frames.reshape(len(frames), 1)
 
-    # apply gains
-    out = []
-    for gain_list in gain_lists:
-        new_channel = numpy.zeros(len(frames))
-        for g, channel in zip(gain_list, channels):
-            new_channel += g * channel
-        out.append(new_channel)
+    out = numpy.dot(frames, gains.transpose())
 
     # special case for monophonic sounds
-    if len(out) == 1:
-        out = out[0]
-        out = numpy.array(out)
-    else:
-        out = numpy.array(out)
-        out = out.transpose()
+    if len(gain_lists) == 1:
+        out = out[:, 0]
 
     return out
 
@@ -70,7 +71,7 @@ def mix_channels_auto(frames, n):
           mix_channels(frames, 1)
 
     """
-    numchan = frames.ndim
+    numchan = _numchan(frames)
     if n == numchan:
         out = frames
     else:
@@ -131,4 +132,11 @@ if __name__ == "__main__":
     frames = numpy.array([1, 2, 3, 4])
     out = mix_channels_auto(frames, 1)
     assert out.tolist() == [1, 2, 3, 4]
-
+    #
+    # more than two channels
+    frames = numpy.arange(24.).reshape(4, 6)
+    out = mix_channels_auto(frames, 1)
+    assert out.tolist() == frames.mean(axis=1).tolist()
+    out = mix_channels(frames, [[1, 0, 0, 0, 0, 1], [0, 1, 0, 0, 1, 0]])
+    assert out.tolist() == (frames[:, [0, 1]] + frames[:, [5, 4]]).tolist()
+    assert mix_channels_auto(numpy.zeros((10, 8)), 8).shape == (10, 8)
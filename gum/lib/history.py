@@ -1,3 +1,101 @@
+import numpy
+import tempfile
+import os
+
+# Default memory budget of a History, in bytes.
+DEFAULT_BUDGET = 512 * 2 ** 20
+
+
+def _arrays(value):
+    """Yield the numpy arrays found in value, which may be an array, a
+    Pieces object, or a list or tuple of them.
+
+    Only the buffers of a Pieces object that are arrays are yielded:
+    slicing other buffers may decode or render frames.
+
+    """
+    if isinstance(value, numpy.ndarray):
+        yield value
+    elif hasattr(value, 'map_spans'):
+        for buffer, offset, length in value.spans():
+            if isinstance(buffer, numpy.ndarray):
+                yield buffer
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            for array in _arrays(v):
+                yield array
+
+
+def _root(array):
+    """Return the array that owns the memory of array."""
+    while isinstance(array.base, numpy.ndarray):
+        array = array.base
+    return array
+
+
+def _usage(value, exclude=()):
+    """Return (ram, disk): bytes used by the numpy arrays found in
+    value, as in _arrays().
+
+    Arrays that share memory are counted once, for the whole array
+    that owns it. Arrays whose owner's id is in exclude are not
+    counted.
+
+    """
+    seen = set(exclude)
+    ram, disk = 0, 0
+    for array in _arrays(value):
+        root = _root(array)
+        if id(root) in seen:
+            continue
+        seen.add(id(root))
+        if isinstance(root, numpy.memmap):
+            disk += root.nbytes
+        else:
+            ram += root.nbytes
+    return ram, disk
+
+
+def _spill_array(array, directory):
+    """Copy array to a temporary file and return it memory-mapped.
+
+    The file is removed right away: its disk space is released when
+    the returned array is garbage-collected.
+
+    """
+    fd, path = tempfile.mkstemp(prefix='gum-history-', suffix='.npy',
+                                dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            numpy.save(f, array)
+        return numpy.load(path, mmap_mode='r')
+    finally:
+        os.remove(path)
+
+
+def _spill(value, directory, exclude=()):
+    """Return value where arrays in RAM are replaced with
+    memory-mapped copies. Arrays whose owner's id is in exclude are
+    kept: copying them would free no memory."""
+    def in_ram(array):
+        return not isinstance(array, numpy.memmap) and \
+               id(_root(array)) not in exclude
+    if isinstance(value, numpy.ndarray):
+        if in_ram(value):
+            return _spill_array(value, directory)
+        return value
+    elif hasattr(value, 'map_spans'):
+        def spill_span(buffer, offset, length):
+            if isinstance(buffer, numpy.ndarray) and in_ram(buffer):
+                b = buffer[offset:offset + length]
+                return _spill_array(b, directory), 0, length
+            return buffer, offset, length
+        return value.map_spans(spill_span)
+    elif isinstance(value, (list, tuple)):
+        return type(value)(_spill(v, directory, exclude) for v in value)
+    return value
+
+
 class Action(object):
     """Describes an action, and a way to revert that action"""
      
@@ -15,14 +113,40 @@ class Action(object):
         fun, args = self._undo
         return fun(*args)
 
+    def values(self):
+        """Return the arguments of the do and undo functions."""
+        return self._do[1], self._undo[1]
+
+    def spill(self, directory=None, exclude=()):
+        """Move the arrays of the action to disk, except those whose
+        owner's id is in exclude."""
+        fun, args = self._do
+        self._do = (fun, _spill(args, directory, exclude))
+        fun, args = self._undo
+        self._undo = (fun, _spill(args, directory, exclude))
+
 
 class History(object):
-    "A list of actions, that can be undone and redone."
+    """A list of actions, that can be undone and redone.
+
+    When the arrays held by the actions take more than budget bytes
+    of memory, those of the oldest actions are moved to temporary
+    files in directory. They are memory-mapped back when needed. A
+    budget of None means no limit.
+
+    live is a function that returns the values in use outside of the
+    history, such as the frames of the sound. Their arrays are neither
+    counted nor moved to disk, since that would free no memory.
+
+    """
 
-    def __init__(self):
+    def __init__(self, budget=DEFAULT_BUDGET, directory=None, live=None):
         self._actions = []
         self._last = -1
         self._counter = 0
+        self.budget = budget
+        self.directory = directory
+        self.live = live
 
     def _push(self, action):
         if self._last < len(self._actions) - 1:
@@ -32,6 +156,28 @@ class History(object):
         self._last = self._last + 1
         self._counter += 1
         action.number = self._counter
+        self._enforce_budget()
+
+    def _live(self):
+        if self.live is None:
+            return set()
+        return set(id(_root(array)) for array in _arrays(self.live()))
+
+    def _enforce_budget(self):
+        if self.budget is None:
+            return
+        live = self._live()
+        for action in self._actions:
+            values = [a.values() for a in self._actions]
+            if _usage(values, live)[0] <= self.budget:
+                break
+            action.spill(self.directory, live)
+
+    def memory_usage(self):
+        """Return the number of bytes held in RAM and on disk by the
+        actions only, as a (ram, disk) tuple. Arrays shared by several
+        actions are counted once."""
+        return _usage([a.values() for a in self._actions], self._live())
         
     def undo(self):
         if self._last < 0:
@@ -52,8 +198,13 @@ class History(object):
     def add(self, do, undo):
         "Does an action and adds it to history."
         action = Action(do, undo)
+        result = action.do()
         self._push(action)
-        return action.do()
+        return result
+
+    def record(self, do, undo):
+        "Adds an action that has already been done to history."
+        self._push(Action(do, undo))
 
     def revision(self):
         if self._last < 0:
@@ -123,5 +274,54 @@ if __name__ == '__main__':
         history.redo()
         assert history.revision() == 4
 
+        # Record an action that is already done
+        calls = []
+        history = History()
+        history.record((calls.append, (1,)), (calls.append, (2,)))
+        assert calls == []
+        history.undo()
+        history.redo()
+        assert calls == [2, 1]
+
+    def testBudget():
+        from gum.lib.pieces import Pieces
+        state = {}
+        def f(x):
+            state['x'] = x
+        a = numpy.arange(1000.)
+        b = numpy.ones(1000)
+        c = numpy.arange(1000.) * 2
+        d = numpy.zeros(1000)
+        history = History(budget=20000)
+        history.add((f, (a,)), (f, (b,)))
+        assert history.memory_usage() == (16000, 0)
+        history.add((f, (Pieces(c),)), (f, ([d],)))
+        # the first action has been moved to disk
+        assert history.memory_usage() == (16000, 16000)
+        assert _usage(history._actions[0].values()) == (0, 16000)
+        history.undo()
+        assert state['x'][0].tolist() == d.tolist()
+        history.undo()
+        assert isinstance(state['x'], numpy.memmap)
+        assert state['x'].tolist() == b.tolist()
+        history.redo()
+        assert state['x'].tolist() == a.tolist()
+        history.redo()
+        assert state['x'].flatten().tolist() == c.tolist()
+
+        # arrays shared by several actions are counted once
+        history = History(budget=None)
+        history.add((f, (a,)), (f, (b,)))
+        history.add((f, (a[10:],)), (f, (Pieces(b),)))
+        assert history.memory_usage() == (16000, 0)
+
+        # arrays still in use are neither counted nor moved to disk
+        history = History(budget=0, live=lambda: Pieces(a[:10]))
+        history.add((f, (a,)), (f, ([b],)))
+        assert history.memory_usage() == (0, 8000)
+        assert state['x'] is a
+        assert history._actions[0].values()[0][0] is a
+
     testAction()
     testHistory()
+    testBudget()
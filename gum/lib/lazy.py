@@ -0,0 +1,189 @@
+# Frames rendered on demand, for the non-destructive mode of Sound.
+#
+# A Lazy buffer stands in a piece table for the output of an effect
+# over some source frames. Nothing is computed when the effect is
+# applied: blocks are rendered when they are read by the player, the
+# display or a writer. Rendered blocks are kept in a cache shared by
+# all Lazy buffers, which holds at most CACHE_SIZE bytes and drops the
+# least recently used blocks first.
+#
+# A Lazy buffer never changes once built, like its source: each one
+# stands for an edit of the sound, and the cache is keyed by that edit
+# and the block index.
+
+import collections
+import itertools
+import threading
+import copy
+import numpy
+
+# Frames rendered at once.
+BLOCKSIZE = 65536
+
+# Bytes of rendered frames kept in the cache.
+CACHE_SIZE = 128 * 2 ** 20
+
+_cache = collections.OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+_keys = itertools.count()
+
+
+def _lookup(key):
+    with _cache_lock:
+        frames = _cache.pop(key, None)
+        if frames is not None:
+            _cache[key] = frames
+        return frames
+
+
+def _store(key, frames):
+    global _cache_bytes
+    with _cache_lock:
+        if key in _cache:
+            return
+        _cache[key] = frames
+        _cache_bytes += frames.nbytes
+        while _cache_bytes > CACHE_SIZE and len(_cache) > 1:
+            key, old = _cache.popitem(last=False)
+            _cache_bytes -= old.nbytes
+
+
+class Framewise(object):
+    """Wraps a function that processes each frame on its own, and
+    returns as many frames as it is given, so that it can be rendered
+    lazily."""
+
+    framewise = True
+
+    def __init__(self, function):
+        self.process = function
+
+
+class Lazy(object):
+    """The frames of source, a Pieces object, through processor.
+
+    processor has a process() method, like effect.Processor, that must
+    return as many frames as it is given. If processor.framewise is
+    True, blocks are rendered independently. Otherwise each block is
+    rendered by a copy of processor in the state left by the previous
+    one. That state is kept for each block rendered so far, so a block
+    that has left the cache is rendered again on its own. Blocks that
+    were never rendered are rendered in order, from the last one that
+    was.
+
+    """
+
+    def __init__(self, source, processor, blocksize=None):
+        self._source = source
+        self._processor = copy.deepcopy(processor)
+        self._framewise = getattr(processor, 'framewise', False)
+        self._blocksize = blocksize or BLOCKSIZE
+        self._key = next(_keys)
+        self._lock = threading.Lock()
+        # Sequential rendering: the state of the processor before each
+        # block rendered so far, and before the next one.
+        self._states = [self._processor]
+
+    def __len__(self):
+        return len(self._source)
+
+    def _read(self, k):
+        bs = self._blocksize
+        return self._source.read(k * bs, (k + 1) * bs)
+
+    def _render(self, k):
+        # Called with self._lock held.
+        if self._framewise:
+            y = self._processor.process(self._read(k))
+            _store((self._key, k), y)
+            return y
+        n = min(k, len(self._states) - 1)
+        processor = copy.deepcopy(self._states[n])
+        while n <= k:
+            y = processor.process(self._read(n))
+            _store((self._key, n), y)
+            n += 1
+            if n == len(self._states):
+                self._states.append(copy.deepcopy(processor))
+        return y
+
+    def _block(self, k):
+        y = _lookup((self._key, k))
+        if y is None:
+            with self._lock:
+                y = _lookup((self._key, k))
+                if y is None:
+                    y = self._render(k)
+        return y
+
+    def __getitem__(self, key):
+        start, stop, step = key.indices(len(self))
+        assert step == 1
+        bs = self._blocksize
+        if stop <= start:
+            return self._source.read(0, 0)
+        first = start // bs
+        blocks = [self._block(k) for k in range(first, -(-stop // bs))]
+        if len(blocks) == 1:
+            y = blocks[0]
+        else:
+            y = numpy.concatenate(blocks)
+        return y[start - first * bs:stop - first * bs]
+
+
+if __name__ == '__main__':
+    from gum.lib.pieces import Pieces
+
+    calls = []
+
+    class Sum(object):
+        # Running sum: each block depends on the previous ones.
+        def __init__(self):
+            self.total = 0
+        def process(self, x):
+            calls.append(len(x))
+            y = numpy.cumsum(x) + self.total
+            self.total = y[-1]
+            return y
+
+    x = numpy.arange(100.)
+    lazy = Lazy(Pieces(x), Sum(), blocksize=16)
+    assert len(lazy) == 100
+    assert calls == []
+    assert lazy[20:30].tolist() == numpy.cumsum(x)[20:30].tolist()
+    assert len(calls) == 2
+    assert lazy[0:5].tolist() == numpy.cumsum(x)[0:5].tolist()
+    assert len(calls) == 2
+    assert lazy[0:100].tolist() == numpy.cumsum(x).tolist()
+    assert lazy[50:50].tolist() == []
+
+    # Framewise processors render only the blocks that are read.
+    del calls[:]
+    double = Framewise(lambda x: calls.append(len(x)) or x * 2)
+    lazy = Lazy(Pieces(x), double, blocksize=16)
+    assert lazy[90:95].tolist() == (x[90:95] * 2).tolist()
+    assert calls == [16]
+
+    # Blocks that leave the cache are rendered again.
+    CACHE_SIZE = 16 * 8
+    lazy = Lazy(Pieces(x), Sum(), blocksize=16)
+    assert lazy[40:50].tolist() == numpy.cumsum(x)[40:50].tolist()
+    assert len(_cache) == 1
+    del calls[:]
+    assert lazy[0:10].tolist() == numpy.cumsum(x)[0:10].tolist()
+    assert calls == [16]
+    # Reading backwards renders each block once.
+    lazy = Lazy(Pieces(x), Sum(), blocksize=16)
+    lazy[96:100]
+    del calls[:]
+    for k in reversed(range(6)):
+        assert lazy[k * 16:k * 16 + 5].tolist() == \
+               numpy.cumsum(x)[k * 16:k * 16 + 5].tolist()
+    assert calls == [16] * 6
+
+    # Stereo, in a piece table.
+    s = numpy.arange(40.).reshape(20, 2)
+    p = Pieces(Lazy(Pieces(s), Framewise(lambda x: -x), blocksize=3))
+    assert p.ndim == 2
+    assert p.read(2, 7).tolist() == (-s[2:7]).tolist()
@@ -0,0 +1,96 @@
+# A pool of threads shared by effects, to process channels, or chunks
+# of frames that do not depend on each other, on all cores. numpy and
+# the compiled kernels release the GIL while they work on arrays, so
+# the threads do run at the same time.
+
+import multiprocessing
+import threading
+import numpy
+
+# Blocks are not split into chunks shorter than this many frames.
+MIN_CHUNK = 16384
+
+_pool = None
+_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def size():
+    """Return the number of threads in the pool."""
+    return multiprocessing.cpu_count()
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from multiprocessing.pool import ThreadPool
+            _pool = ThreadPool(size())
+    return _pool
+
+
+def _call(args):
+    function, item = args
+    _local.worker = True
+    try:
+        return function(item)
+    finally:
+        _local.worker = False
+
+
+def map(function, sequence):
+    """Return the list of function(item) for each item of sequence,
+    computed by the pool of threads.
+
+    Items are processed in the calling thread when there are less than
+    two of them, when there is a single core, or when called from the
+    pool itself.
+
+    """
+    sequence = list(sequence)
+    if (len(sequence) < 2 or size() < 2
+        or getattr(_local, 'worker', False)):
+        return [function(item) for item in sequence]
+    return _get_pool().map(_call, [(function, item) for item in sequence])
+
+
+def split(frames, minsize=MIN_CHUNK):
+    """Split frames into at most one chunk per thread, of at least
+    minsize frames each. Return the list of chunks, which are views."""
+    n = max(1, min(size(), len(frames) // max(minsize, 1)))
+    step = max(1, -(-len(frames) // n))
+    return [frames[i:i + step] for i in range(0, len(frames), step)] or \
+           [frames]
+
+
+def map_frames(function, frames, minsize=MIN_CHUNK):
+    """Apply function to chunks of frames in parallel and return the
+    concatenated results. function must process each frame on its
+    own."""
+    chunks = split(frames, minsize)
+    if len(chunks) == 1:
+        return function(frames)
+    return numpy.concatenate(map(function, chunks))
+
+
+if __name__ == '__main__':
+    # Use several threads, even on a single core.
+    size = lambda: 4
+    assert map(lambda x: x * 2, range(10)) == range(0, 20, 2)
+    assert map(abs, []) == []
+
+    # Nested calls run in the calling thread instead of waiting for a
+    # busy pool.
+    def inner(x):
+        return sum(map(lambda y: x * y, range(100)))
+    assert map(inner, range(50)) == [x * 4950 for x in range(50)]
+
+    x = numpy.arange(100000.)
+    chunks = split(x, 1000)
+    assert 1 <= len(chunks) <= size()
+    assert numpy.concatenate(chunks).tolist() == x.tolist()
+    assert len(split(x, 10 ** 6)) == 1
+    assert len(split(x[:0])) == 1
+    assert (map_frames(lambda c: c * 2, x, 1000) == x * 2).all()
+    stereo = numpy.ones((50000, 2))
+    assert map_frames(lambda c: c + 1, stereo, 1000).shape == (50000, 2)
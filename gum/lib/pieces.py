@@ -0,0 +1,201 @@
+# Piece table storage for sound frames.
+#
+# A Pieces object is a sequence of frames described as a list of spans
+# (buffer, offset, length) over buffers that are never modified. Cutting,
+# pasting and undoing only rearrange spans; frames are copied when a flat
+# array is actually requested.
+
+import numpy
+import bisect
+
+
+class Pieces(object):
+    """An immutable sequence of frames stored as spans over buffers.
+
+    A buffer is a numpy array, or any object that has a length and
+    returns a numpy array when sliced. Buffers must not be modified
+    once they are part of a Pieces object.
+
+    """
+
+    def __init__(self, buffer=None):
+        if buffer is None:
+            buffer = numpy.array([])
+        self._empty = buffer[0:0]
+        spans = []
+        if len(buffer):
+            spans.append((buffer, 0, len(buffer)))
+        self._set_spans(spans)
+
+    @classmethod
+    def join(cls, buffers, empty=None):
+        """Return a Pieces object holding the frames of each buffer in
+        turn. empty is a zero-length array that gives the shape of the
+        frames when there is no buffer."""
+        if empty is None:
+            if buffers:
+                empty = buffers[0][0:0]
+            else:
+                empty = numpy.array([])
+        spans = [(buffer, 0, len(buffer)) for buffer in buffers]
+        return cls._from_spans(spans, empty)
+
+    @classmethod
+    def _from_spans(cls, spans, empty):
+        p = cls.__new__(cls)
+        p._empty = empty
+        p._set_spans(spans)
+        return p
+
+    def _set_spans(self, spans):
+        self._spans = []
+        self._starts = []
+        self._length = 0
+        for buffer, offset, length in spans:
+            if length <= 0:
+                continue
+            if self._spans:
+                # Coalesce contiguous spans over the same buffer.
+                pbuffer, poffset, plength = self._spans[-1]
+                if pbuffer is buffer and poffset + plength == offset:
+                    self._spans[-1] = (buffer, poffset, plength + length)
+                    self._length += length
+                    continue
+            self._spans.append((buffer, offset, length))
+            self._starts.append(self._length)
+            self._length += length
+
+    @property
+    def ndim(self):
+        return self._empty.ndim
+
+    def __len__(self):
+        return self._length
+
+    def spans(self):
+        """Return the list of (buffer, offset, length) spans."""
+        return list(self._spans)
+
+    def _overlap(self, start, end):
+        """Yield (buffer, a, b) for each span overlapping [start, end).
+
+        a and b are indexes in the buffer.
+
+        """
+        start = max(0, start)
+        end = min(end, self._length)
+        if end <= start:
+            return
+        i = bisect.bisect_right(self._starts, start) - 1
+        while i < len(self._spans) and self._starts[i] < end:
+            buffer, offset, length = self._spans[i]
+            s = self._starts[i]
+            a = max(start, s) - s + offset
+            b = min(end, s + length) - s + offset
+            yield buffer, a, b
+            i += 1
+
+    def read(self, start, end):
+        """Return frames from start to end as a numpy array.
+
+        The array may be a view on a buffer and must not be modified.
+
+        """
+        chunks = [buffer[a:b] for buffer, a, b in self._overlap(start, end)]
+        if not chunks:
+            return self._empty
+        if len(chunks) == 1:
+            return chunks[0]
+        return numpy.concatenate(chunks)
+
+    def flatten(self):
+        return self.read(0, self._length)
+
+    def slice(self, start, end):
+        """Return the frames from start to end as a new Pieces object."""
+        spans = [(buffer, a, b - a)
+                 for buffer, a, b in self._overlap(start, end)]
+        return Pieces._from_spans(spans, self._empty)
+
+    def replace(self, start, end, other):
+        """Return a new Pieces object where frames from start to end
+        are replaced with the frames of other."""
+        head = self.slice(0, start)._spans
+        tail = self.slice(end, self._length)._spans
+        return Pieces._from_spans(head + other._spans + tail, self._empty)
+
+    def map_spans(self, function):
+        """Return a new Pieces object where each span is replaced with
+        function(buffer, offset, length), which must return a span of
+        the same length."""
+        spans = [function(*span) for span in self._spans]
+        return Pieces._from_spans(spans, self._empty)
+
+    def __add__(self, other):
+        return Pieces._from_spans(self._spans + other._spans, self._empty)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self._length)
+            if step == 1:
+                return self.read(start, stop)
+        return self.flatten()[key]
+
+
+if __name__ == '__main__':
+
+    def test_pieces():
+        x = numpy.arange(10)
+        p = Pieces(x)
+        assert len(p) == 10
+        assert p.ndim == 1
+        assert p.flatten().base is x  # no copy
+        assert p[2:5].tolist() == [2, 3, 4]
+
+        # cut
+        q = p.replace(2, 5, Pieces())
+        assert q.flatten().tolist() == [0, 1, 5, 6, 7, 8, 9]
+        assert len(q.spans()) == 2
+        # p is unchanged
+        assert p.flatten().tolist() == range(10)
+
+        # undo the cut: spans are coalesced back
+        r = q.replace(2, 2, p.slice(2, 5))
+        assert r.flatten().tolist() == range(10)
+        assert len(r.spans()) == 1
+
+        # paste
+        clip = Pieces(numpy.array([20, 30]))
+        s = p.replace(1, 1, clip)
+        assert s.flatten().tolist() == [0, 20, 30, 1, 2, 3, 4, 5, 6, 7, 8, 9]
+        assert s[0:3].tolist() == [0, 20, 30]
+        assert s[2:4].tolist() == [30, 1]
+        assert s[-2:].tolist() == [8, 9]
+        assert s.slice(1, 4).flatten().tolist() == [20, 30, 1]
+        assert (s + clip).flatten().tolist()[-3:] == [9, 20, 30]
+
+        # join
+        j = Pieces.join([x[:4], clip.flatten(), x[4:]])
+        assert len(j.spans()) == 3
+        assert j.flatten().tolist() == [0, 1, 2, 3, 20, 30, 4, 5, 6, 7, 8, 9]
+        assert len(Pieces.join([])) == 0
+
+        # out of bounds
+        assert p.read(8, 20).tolist() == [8, 9]
+        assert p.read(12, 20).tolist() == []
+
+        # stereo
+        x = numpy.array([[1, 1], [2, 2], [3, 3]])
+        p = Pieces(x)
+        assert p.ndim == 2
+        p = p.replace(1, 2, Pieces())
+        assert p.flatten().tolist() == [[1, 1], [3, 3]]
+        assert p.read(5, 6).shape == (0, 2)
+
+        # empty
+        p = Pieces()
+        assert len(p) == 0
+        assert p.flatten().tolist() == []
+        assert p.ndim == 1
+
+    test_pieces()
@@ -3,22 +3,70 @@
 # Licensed under the Revised BSD License.
 
 from gum.lib.event import Signal
-from gum.lib import history, edit
+from gum.lib import history, edit, pieces, lazy
 from gum.lib import audiofile
 import pysndfile
 from copy import copy
 import os.path
+import threading
+import time
 import numpy
 
+# While a sound is decoded in the background, listeners are notified
+# of the new frames at most once per LOAD_INTERVAL seconds.
+LOAD_INTERVAL = 0.5
+
+# Framewise transforms are computed and checked against their inverse
+# this many frames at a time.
+BLOCKSIZE = 65536
+
+
+def dispatch(function, *args):
+    """Call function with args in the thread that runs the user
+    interface. A sound that is loaded in the background notifies its
+    listeners through dispatch(), which the user interface replaces
+    with a function that posts to its main loop. By default, function
+    is called right away."""
+    function(*args)
+
 
 class Sound(object):
 
-    # frames is a numpy.ndarray, as returned by pysndfile
+    # frames is a numpy.ndarray, as returned by pysndfile. It is built
+    # on demand from a piece table and must not be modified in place.
+    # Use read() and numframes() to avoid building it: the piece table
+    # may be backed by a memory-mapped file.
+    #
+    # dtype is the storage mode, one of audiofile.DTYPES. In the
+    # compact modes ('float32' and 'native'), edited frames are stored
+    # as float32.
+    #
+    # If background is True, a file that must be decoded by ffmpeg is
+    # loaded by a thread: frames are appended to the sound as they are
+    # decoded, and changed is emitted through dispatch().
+    #
+    # If nondestructive is True, effects that keep the number of frames
+    # are not computed when applied: the piece table refers to their
+    # output as lazy.Lazy buffers, rendered when frames are read. Edits
+    # and undo then never copy frames.
+    #
+    # changed is emitted with (start, end, delta) after each edit: the
+    # frames from start to end were replaced, and the sound is now
+    # delta frames longer. Listeners called without arguments must
+    # assume that the whole sound changed.
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, dtype='float64', background=False,
+                 nondestructive=False):
         self.filename = filename
-        self.history = history.History()
+        self.dtype = dtype
+        self.nondestructive = nondestructive
+        # The frames in use are not counted in the history budget.
+        self.history = history.History(live=lambda: self._pieces)
         self.changed = Signal()
+        self._lock = threading.RLock()
+        self._decoder = None
+        self._pieces = pieces.Pieces()
+        self._dirty = None
         if filename == None:
             # empty sound
             self.frames = numpy.array([])
@@ -27,65 +75,263 @@ class Sound(object):
             self._format = pysndfile.construct_format('wavex', 'pcm24')
         else:
             filename = os.path.expanduser(filename)
-            file = audiofile.read(filename)
-            self.frames = file.data
+            file = audiofile.read(filename, dtype, background)
             self.samplerate = file.samplerate
             self._format = file.format
             self._saved_revision = self.history.revision()
+            if isinstance(file.data, audiofile.Decoder):
+                self._load(file.data)
+            else:
+                self.frames = file.data
+        # Listeners are only notified of the edits made from now on.
+        with self._lock:
+            self._dirty = None
+
+    def _load(self, decoder):
+        self.frames = decoder.empty
+        self._decoder = decoder
+        self._notified = time.time()
+        decoder.decoded.connect(self._on_decoded)
+        decoder.finished.connect(self._on_loaded)
+        decoder.start()
+
+    def _on_decoded(self, block):
+        with self._lock:
+            n = len(self._pieces)
+            self._set_pieces(self._pieces + pieces.Pieces(block), n, n)
+        now = time.time()
+        if now - self._notified >= LOAD_INTERVAL:
+            self._notified = now
+            dispatch(self.notify)
+
+    def _on_loaded(self, error):
+        dispatch(self._loaded)
+
+    def _loaded(self):
+        # Listeners see the last frames while the sound is still loading.
+        self.notify()
+        self._decoder = None
+
+    def is_loading(self):
+        """True while frames are being decoded in the background."""
+        return self._decoder is not None
+
+    def close(self):
+        """Stop loading the sound, if it is still being decoded."""
+        decoder = self._decoder
+        if decoder is not None:
+            decoder.close()
+
+    def _get_frames(self):
+        with self._lock:
+            if self._frames is None:
+                frames = self._pieces.flatten()
+                if len(self._pieces.spans()) > 1:
+                    # The flat array is a fresh copy: use it as the only
+                    # buffer from now on.
+                    frames.flags.writeable = False
+                    self._pieces = pieces.Pieces(frames)
+                self._frames = frames
+            return self._frames
+
+    def _set_frames(self, frames):
+        if not isinstance(frames, pieces.Pieces):
+            frames = pieces.Pieces(frames)
+        self._set_pieces(frames)
+
+    frames = property(_get_frames, _set_frames)
+
+    def _set_pieces(self, p, start=0, end=None):
+        """Replace the piece table with p, in which the frames from
+        start to end of the current one have been replaced; by default,
+        all of them."""
+        n = len(self._pieces)
+        if end is None or end > n:
+            end = n
+        self._pieces = p
+        self._frames = None
+        self._edited(min(start, end), end, len(p) - n)
+
+    def _edited(self, start, end, delta):
+        # Merge the edit into the range that listeners have not been
+        # notified of yet. Both edits are turned into the frames of
+        # the sound before the first one that they replace.
+        if self._dirty is None:
+            self._dirty = (start, end, delta)
+            return
+        s, e, d = self._dirty
+        stop = max(e + d, end)
+        self._dirty = (min(s, start), stop - d, d + delta)
+
+    def notify(self):
+        """Emit changed with the range of frames edited since the last
+        notification, if any."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, None
+        if dirty is not None:
+            self.changed(*dirty)
 
     def numchan(self):
-        return self.frames.ndim
+        return self._pieces.ndim
+
+    def numframes(self):
+        return len(self._pieces)
+
+    def read(self, start, end):
+        """Return frames from start to end, without building the whole
+        frames array. The result must not be modified."""
+        return self._pieces.read(start, end)
 
     def save(self):
         self.save_as(self.filename)
 
-    def save_as(self, filename):
+    def save_as(self, filename, background=False, callback=None,
+                progress=None):
+        """Save the sound to filename.
+
+        If background is True, the file is written by a thread from a
+        snapshot of the sound, which may be edited meanwhile, and the
+        audiofile.Writer is returned. From the thread, progress is
+        called with the fraction of the file written, and callback
+        with the writer error, or None, once the sound state is
+        updated.
+
+        """
         if filename is None:
             raise Exception("No filename")
-        file = audiofile.AudioFile(self.frames, self.samplerate, self._format)
-        audiofile.write(filename, file)
+        file = audiofile.AudioFile(self._pieces, self.samplerate,
+                                   self._format)
+        revision = self.history.revision()
+        if not background:
+            audiofile.write(filename, file)
+            self._saved(filename, revision)
+            return
+        def finished(error):
+            if error is None:
+                self._saved(filename, revision)
+            if callback is not None:
+                callback(error)
+        writer = audiofile.Writer(filename, file)
+        writer.finished.connect(finished)
+        if progress is not None:
+            writer.progress.connect(progress)
+        writer.start()
+        return writer
+
+    def _saved(self, filename, revision):
         self.filename = filename
-        self._saved_revision = self.history.revision()
+        self._saved_revision = revision
 
     def cut(self, start, end):
-        clip = copy(self.frames[start:end])
+        clip = copy(self._pieces.read(start, end))
+        saved = self._pieces.slice(start, end)
         do = (self._do_cut, (start, end))
-        undo = (self._do_paste, (start, start, clip))
-        self.history.add(do, undo)
-        self.changed()
+        undo = (self._do_paste, (start, start, saved))
+        with self._lock:
+            self.history.add(do, undo)
+        self.notify()
         return clip
     
     def _do_cut(self, start, end):
-        data = numpy.concatenate((self.frames[:start], self.frames[end:]))
-        self.frames = data
+        self._set_pieces(self._pieces.replace(start, end, pieces.Pieces()),
+                         start, end)
 
     def copy(self, start, end):
-        clip = copy(self.frames[start:end])
+        clip = copy(self._pieces.read(start, end))
+        return clip
+
+    def compact(self, clip):
+        """Return clip in the storage mode of the sound."""
+        if self.dtype != 'float64' and clip.dtype == numpy.float64:
+            clip = clip.astype(numpy.float32)
         return clip
 
     def paste(self, start, end, clip):
-        saved = copy(self.frames[start:end])
+        if not isinstance(clip, pieces.Pieces):
+            clip = self.compact(clip)
+        saved = self._pieces.slice(start, end)
         do = (self._do_paste, (start, end, clip))
         undo = (self._do_paste, (start, start + len(clip), saved))
-        self.history.add(do, undo)
-        self.changed()
+        with self._lock:
+            self.history.add(do, undo)
+        self.notify()
 
     def _do_paste(self, start, end, clip):
+        if not isinstance(clip, pieces.Pieces):
+            if not self.is_empty():
+                # FIXME: should resample
+                clip = edit.mix_channels_auto(clip, self.numchan())
+            clip = pieces.Pieces(clip)
         if self.is_empty():
-            self.frames = clip
+            self._set_pieces(clip)
         else:
-            # FIXME: should resample
-            clip = edit.mix_channels_auto(clip, self.numchan())
-            x = self.frames
-            y = numpy.concatenate((x[:start], clip, x[end:]))
-            self.frames = y
+            self._set_pieces(self._pieces.replace(start, end, clip),
+                             start, end)
+
+    def apply(self, start, end, processor):
+        """Replace the frames from start to end with their output
+        through processor, like effect.Processor, which must return as
+        many frames as it is given. The output is rendered when it is
+        read."""
+        source = lazy.Lazy(self._pieces.slice(start, end), processor)
+        self.paste(start, end, pieces.Pieces(source))
+
+    def transform(self, start, end, function, inverse=None,
+                  framewise=False):
+        """Replace the frames from start to end with function(frames),
+        which must return as many frames.
+
+        inverse is a function that reverts function exactly. The history
+        keeps it instead of the original frames if they are arrays in
+        memory, and if inverse gives them back. Otherwise, or if inverse
+        is None, the original frames are kept: frames of a file are
+        then neither copied nor requantized.
+
+        framewise tells that function processes each frame on its own:
+        in non-destructive mode, it is then applied lazily, and otherwise
+        block by block.
+
+        """
+        if self.nondestructive and framewise:
+            self.apply(start, end, lazy.Framewise(function))
+            return
+        saved = self._pieces.slice(start, end)
+        n = len(saved)
+        step = BLOCKSIZE if framewise else max(n, 1)
+        exact = inverse is not None and _in_memory(saved)
+        blocks = []
+        for i in range(0, n, step):
+            x = saved.read(i, min(i + step, n))
+            y = self.compact(function(x))
+            assert len(y) == len(x)
+            exact = exact and numpy.array_equal(inverse(y), x)
+            blocks.append(y)
+        y = pieces.Pieces.join(blocks, self.compact(saved.read(0, 0)))
+        if not exact:
+            self.paste(start, end, y)
+            return
+        do = (self._do_transform, (start, end, function))
+        undo = (self._do_transform, (start, end, inverse))
+        with self._lock:
+            self._set_pieces(self._pieces.replace(start, end, y), start, end)
+            self.history.record(do, undo)
+        self.notify()
+
+    def _do_transform(self, start, end, function):
+        x = self._pieces.read(start, end)
+        y = function(x)
+        assert len(y) == len(x)
+        y = pieces.Pieces(self.compact(y))
+        self._set_pieces(self._pieces.replace(start, start + len(x), y),
+                         start, start + len(x))
 
     def mix(self, start, end, clip):
-        saved = copy(self.frames[start:start + len(clip)])
+        saved = self._pieces.slice(start, start + len(clip))
         do = (self._do_mix, (start, end, clip))
         undo = (self._do_paste, (start, start + len(clip), saved))
-        self.history.add(do, undo)
-        self.changed()
+        with self._lock:
+            self.history.add(do, undo)
+        self.notify()
 
     def _do_mix(self, start, end, clip):
         if self.is_empty():
@@ -95,30 +341,30 @@ class Sound(object):
             clip = edit.mix_channels_auto(clip, self.numchan())
             if start != end:
                 length = min(end - start, len(clip))
-                chunk = clip[:length].astype(self.frames.dtype) # FIXME
-                self.frames[start:start + length] += chunk
+                x = self._pieces.read(start, start + length)
+                y = x + clip[:length].astype(x.dtype) # FIXME
             else:
-                a = self.frames
-                b = clip
-                sound_length = max(len(a), start + len(b))
-                if self.numchan() > 1:
-                    c = numpy.zeros((sound_length, self.numchan()))
-                else:
-                    c = numpy.zeros(sound_length)
-                c[:len(a)] = a
-                c[start:start + len(b)] += b
-                self.frames = c
+                # The sound may be extended.
+                length = min(len(self._pieces) - start, len(clip))
+                x = self._pieces.read(start, start + length)
+                y = numpy.array(clip, dtype='float64')
+                y[:len(x)] += x
+            y = pieces.Pieces(self.compact(y))
+            self._set_pieces(self._pieces.replace(start, start + length, y),
+                             start, start + length)
 
     def undo(self):
-        self.history.undo()
-        self.changed()
+        with self._lock:
+            self.history.undo()
+        self.notify()
 
     def redo(self):
-        self.history.redo()
-        self.changed()
+        with self._lock:
+            self.history.redo()
+        self.notify()
 
     def is_empty(self):
-        return not len(self.frames)
+        return not len(self._pieces)
 
     def is_fresh(self):
         """True if sound is empty and has never been edited."""
@@ -128,6 +374,13 @@ class Sound(object):
         return self._saved_revision == self.history.revision()
 
 
+def _in_memory(p):
+    """True if the frames of the Pieces object p are arrays in memory."""
+    return all(isinstance(buffer, numpy.ndarray)
+               and not isinstance(buffer, numpy.memmap)
+               for buffer, offset, length in p.spans())
+
+
 # -- Tests
 
 def testSound():
@@ -212,6 +465,14 @@ def testSound():
     snd.paste(0, 0, clip)
     assert snd.frames.tolist() == data2[start:end] + data2
 
+    # files are memory-mapped and decoded on demand
+    snd = Sound(testdir + "/test2.wav")
+    buffer, offset, length = snd._pieces.spans()[0]
+    assert isinstance(buffer, audiofile.MappedFrames)
+    assert snd.numframes() == length
+    assert snd.read(10, 20).shape == (10, 2)
+    assert snd._frames is None
+
     # test save_as()
     import os
     snd = Sound(testdir + "/test1.wav")
@@ -233,6 +494,24 @@ def testSound():
     assert abs((snd.frames - snd2.frames).flatten().max()) == 0
     os.remove(outfile)
 
+    # Save in the background while editing
+    snd = Sound(testdir + "/test2.wav")
+    data = snd.frames.tolist()
+    outfile = "/tmp/test2.wav"
+    errors = []
+    def finished(error):
+        errors.append(error)
+    writer = snd.save_as(outfile, background=True, callback=finished)
+    snd.cut(0, 1000)
+    writer.join()
+    assert errors == [None]
+    assert snd.filename == outfile
+    assert not snd.is_saved()
+    snd.undo()
+    assert snd.is_saved()
+    assert Sound(outfile).frames.tolist() == data
+    os.remove(outfile)
+
     # Preserve file format when saving
     snd = Sound(testdir + "/test3.wav")
     outfile = "/tmp/test3.wav"
@@ -242,6 +521,22 @@ def testSound():
     assert snd.samplerate == 48000
     os.remove(outfile)
 
+    # Compact storage: untouched regions are saved without requantization
+    for name in ["test1.wav", "test2.wav", "test3.wav"]:
+        snd = Sound(testdir + "/" + name, dtype='native')
+        x = snd.read(1000, 2000)
+        snd.paste(1000, 2000, x * 0.5)
+        assert snd.read(1000, 2000).dtype == numpy.float32
+        outfile = "/tmp/test_native.wav"
+        snd.save_as(outfile)
+        f1 = pysndfile.PySndfile(testdir + "/" + name)
+        f2 = pysndfile.PySndfile(outfile)
+        a = f1.read_frames(dtype=numpy.int32)
+        b = f2.read_frames(dtype=numpy.int32)
+        assert (a[:1000] == b[:1000]).all()
+        assert (a[2000:] == b[2000:]).all()
+        os.remove(outfile)
+
     # test cut
     snd = Sound()
     snd.frames = numpy.array([1, 2, 3, 4])
@@ -369,6 +664,127 @@ def testSound():
     snd.mix(1, 3, clip)
     assert snd.frames.tolist() == [[1, 1], [22, 22], [33, 33], [4, 4]]
 
+    # transform: the history keeps the inverse, not the frames
+    snd = Sound()
+    x = numpy.arange(1., 100001.)
+    snd.frames = x
+    double = lambda x: x * 2
+    half = lambda x: x / 2
+    snd.transform(10, 20, double, half)
+    assert snd.frames.tolist() == x[:10].tolist() + (x[10:20] * 2).tolist() \
+                                  + x[20:].tolist()
+    snd.transform(0, len(x), double, half)
+    assert snd.history.memory_usage() == (0, 0)
+    snd.undo()
+    snd.undo()
+    assert snd.frames.tolist() == x.tolist()
+    snd.redo()
+    assert snd.frames[10:20].tolist() == (x[10:20] * 2).tolist()
+    # without inverse, the original frames are kept. They are counted
+    # in the history budget once the sound no longer uses them.
+    snd.transform(0, 10, double)
+    assert snd.history.memory_usage() == (0, 0)
+    snd.frames
+    assert snd.history.memory_usage()[0] > 0
+    snd.undo()
+    assert snd.frames[:10].tolist() == x[:10].tolist()
+    # and so they are if the inverse is not exact
+    snd = Sound()
+    snd.frames = numpy.random.uniform(-1, 1, 1000)
+    x = snd.frames
+    snd.transform(0, 1000, lambda x: x * 0.3, lambda x: x / 0.3)
+    assert snd.history.memory_usage()[0] > 0
+    snd.undo()
+    assert (snd.frames == x).all()
+    # or if the frames are not in memory
+    class Mapped(object):
+        def __init__(self, frames):
+            self.frames = frames
+        def __len__(self):
+            return len(self.frames)
+        def __getitem__(self, key):
+            return self.frames[key]
+    mapped = Mapped(x)
+    snd.frames = pieces.Pieces(mapped)
+    snd.transform(10, 20, double, half)
+    snd.undo()
+    assert snd._pieces.spans() == [(mapped, 0, 1000)]
+    # framewise functions are computed once, block by block
+    snd = Sound()
+    x = numpy.arange(1., BLOCKSIZE * 2 + 12)
+    snd.frames = x
+    calls = []
+    def double(x):
+        calls.append(len(x))
+        return x * 2
+    snd.transform(5, len(x) - 5, double, half, framewise=True)
+    assert calls == [BLOCKSIZE, BLOCKSIZE, 1]
+    assert snd.frames.tolist() == x[:5].tolist() + \
+        (x[5:-5] * 2).tolist() + x[-5:].tolist()
+    assert snd.history.memory_usage() == (0, 0)
+    snd.undo()
+    assert snd.frames.tolist() == x.tolist()
+
+    # non-destructive mode: effects are rendered when read
+    snd = Sound(nondestructive=True)
+    x = numpy.arange(1., 100001.)
+    snd.frames = x
+    calls = []
+    def double(x):
+        calls.append(len(x))
+        return x * 2
+    snd.transform(10, 99990, double, framewise=True)
+    snd.transform(0, 100000, double, framewise=True)
+    assert calls == []
+    assert snd.read(0, 20).tolist() == \
+        (x[:10] * 2).tolist() + (x[10:20] * 4).tolist()
+    assert len(calls) == 2
+    snd.undo()
+    assert snd.read(0, 20).tolist() == \
+        x[:10].tolist() + (x[10:20] * 2).tolist()
+    snd.undo()
+    assert snd.frames.tolist() == x.tolist()
+
+    # changed carries the edited range and the length delta
+    snd = Sound()
+    changes = []
+    def on_changed(*args):
+        changes.append(args)
+    snd.changed.connect(on_changed)
+    snd.frames = numpy.arange(100.)
+    snd.cut(10, 20)
+    snd.paste(5, 5, numpy.zeros(3))
+    snd.transform(50, 60, lambda x: x * 2, lambda x: x / 2)
+    snd.undo()
+    snd.undo()
+    # Edits that were not notified are merged with the next one.
+    assert changes == [(0, 0, 90), (5, 5, 3), (50, 60, 0), (50, 60, 0),
+                       (5, 8, -3)]
+    del changes[:]
+    snd._set_pieces(snd._pieces.replace(80, 90, pieces.Pieces()), 80, 90)
+    snd._set_pieces(snd._pieces.replace(0, 2, pieces.Pieces()), 0, 2)
+    snd.notify()
+    snd.notify()
+    assert changes == [(0, 90, -12)]
+
+    # cut and undo only rearrange the piece table
+    snd = Sound()
+    snd.frames = numpy.array(range(10))
+    snd.cut(2, 5)
+    assert len(snd._pieces.spans()) == 2
+    snd.undo()
+    assert len(snd._pieces.spans()) == 1
+    assert snd.frames.tolist() == range(10)
+    snd.paste(3, 3, numpy.array([42]))
+    assert snd.frames.tolist() == [0, 1, 2, 42] + range(3, 10)
+    # the flat array is read-only: it may be shared with the history
+    try:
+        snd.frames[0] = 1
+    except ValueError:
+        pass
+    else:
+        assert False
+
     # Do not crash when saving with None as filename
     snd = Sound()
     try:
@@ -388,5 +804,31 @@ def testSound():
     Sound("~/sound.wav")
     pysndfile.PySndfile = orig
 
+def testDispatch():
+    # Listeners of a sound loaded in the background are notified
+    # through dispatch().
+    global dispatch
+    posted = []
+    def post(function, *args):
+        posted.append((function, args))
+    orig = dispatch
+    dispatch = post
+    snd = Sound()
+    snd._decoder = object()
+    snd._notified = 0
+    changes = []
+    def on_changed(*args):
+        changes.append(args)
+    snd.changed.connect(on_changed)
+    snd._on_decoded(numpy.zeros(10))
+    snd._on_loaded(None)
+    assert changes == [] and snd.is_loading()
+    for function, args in posted:
+        function(*args)
+    assert changes == [(0, 0, 10)]
+    assert not snd.is_loading()
+    dispatch = orig
+
 if __name__ == '__main__':
+    testDispatch()
     testSound()
@@ -1,2 +1,12 @@
-from effect import EffectDialog
+# Front ends without a user interface may replace this with a class
+# that has the same interface as effect.EffectDialog.
+dialog_class = None
+
+def EffectDialog(*args, **kwargs):
+    # gtk is only imported when a dialog is created.
+    if dialog_class is not None:
+        return dialog_class(*args, **kwargs)
+    from effect import EffectDialog
+    return EffectDialog(*args, **kwargs)
+
 from graph import Graph
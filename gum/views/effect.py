@@ -9,6 +9,13 @@ class EffectDialog(gtk.Dialog):
                             gtk.STOCK_APPLY, gtk.RESPONSE_ACCEPT))
 
         self.parameters = {}
+        # Set by the effect: a function that returns an effect.Processor
+        # for given parameters. Set by the editor: a function that plays
+        # the selection through a processor, or stops if given None.
+        # Both are needed to preview the effect.
+        self.processor = None
+        self.preview = None
+        self._previewing = False
         self.set_decorated(False)
         self.resize(400, 1)
         self.set_icon_from_file(logofile)
@@ -38,17 +45,46 @@ class EffectDialog(gtk.Dialog):
         self.table.attach(scale, 1, 2, vposition, vposition + 1,
                           xoptions=gtk.EXPAND|gtk.FILL)
 
+    def _values(self):
+        values = {}
+        for name in self.parameters:
+            adj = self.parameters[name]
+            values[name] = adj.get_value()
+        return values
+
+    def _update_preview(self, *args):
+        if self._previewing:
+            self.preview(self.processor(self._values()))
+
+    def _toggle_preview(self, button):
+        self._previewing = button.get_active()
+        if self._previewing:
+            self._update_preview()
+        else:
+            self.preview(None)
+
+    def _add_preview_button(self):
+        button = gtk.CheckButton("Preview")
+        button.connect("toggled", self._toggle_preview)
+        align = gtk.Alignment(0, 0, 0, 0)
+        align.set_padding(0, 10, 20, 20)
+        align.add(button)
+        self.vbox.pack_start(align, expand=False, fill=False)
+        for adj in self.parameters.values():
+            adj.connect("value-changed", self._update_preview)
+
     def proceed(self):
+        if self.processor is not None and self.preview is not None:
+            self._add_preview_button()
         self.show_all()
         response = self.run()
         self.hide()
+        if self._previewing:
+            self._previewing = False
+            self.preview(None)
         if response != gtk.RESPONSE_ACCEPT:
             return
-        values = {}
-        for name in self.parameters:
-            adj = self.parameters[name]
-            values[name] = adj.get_value()
-        self.callback(values)
+        self.callback(self._values())
 
     def callback(self, parameters):
         """Reaffect this attribute with a method that will apply the effect."""
@@ -59,4 +95,10 @@ if __name__ == '__main__':
     d = EffectDialog('Effect')
     d.add_slider("Delay", 500, 0, 5000)
     d.add_slider("Feedback", 50, 0, 99)
+    def processor(parameters):
+        print parameters
+    def preview(processor):
+        pass
+    d.processor = processor
+    d.preview = preview
     d.proceed()
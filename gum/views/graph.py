@@ -19,9 +19,11 @@ class Graph(object):
         self.changed = Signal()
         self._sound = None
         self._display = None
+        self._numchan = None
         self._view_start = 0
         self._width_px = 100.
         self._density = 1.
+        self._whole = True
         self.set_sound(sound)
 
     def _get_density(self):
@@ -47,9 +49,21 @@ class Graph(object):
         self._sound.changed.connect(self.on_sound_changed)
         self.on_sound_changed()
 
-    def on_sound_changed(self):
-        self._display = display.Waveform(self._sound.frames)
-        self._update()
+    def on_sound_changed(self, start=None, end=None, delta=0):
+        # Only the edited frames are summarized again, unless the whole
+        # sound may have changed. Sounds loaded in the background call
+        # this from the main loop, through sound.dispatch().
+        numchan = self._sound.numchan()
+        if start is None or numchan != self._numchan:
+            self._display = display.Waveform(self._sound)
+            self._numchan = numchan
+        else:
+            self._display.update(start, end, delta)
+        if self._sound.is_loading() and self._whole:
+            # Keep a sound that is being decoded entirely in view.
+            self.zoom_out_full()
+        else:
+            self._update()
 
     def set_width(self, width):
         start, end = self.view()
@@ -66,10 +80,11 @@ class Graph(object):
             self._view_start = 0
         # Move the overview to the new display region.
         self._display.set(self._view_start, self._width_px, self._density)
+        self._whole = self.is_zoomed_out_full()
         self.changed()
 
     def numframes(self):
-        return len(self._sound.frames)
+        return self._sound.numframes()
 
     def view(self):
         """
@@ -193,12 +208,18 @@ class Graph(object):
 DTYPE = 'float64'
 
 
+def channels(graph):
+    """Return the (min, max) cells of each channel in view."""
+    from display.overview import MIN, MAX
+    cells = graph._display._overview(*graph._display._view)
+    return [[(cell[MIN], cell[MAX]) for cell in channel]
+            for channel in cells.tolist()]
+
+
 def test_middle():
-    from gum.lib.mock import Mock, Fake
+    from gum.models import Sound
     import numpy
-    sound = Mock({"numchan": 1})
-    sound.changed = Fake()
-    sound.frames = []
+    sound = Sound()
     g = Graph(sound)
     for nframes, mid in [(4, 1.5), (9, 4), (10, 4.5)]:
         sound.frames = numpy.array(range(nframes))
@@ -207,16 +228,15 @@ def test_middle():
 
 
 def test_Graph():
-    from gum.lib.mock import Mock, Fake
+    from gum.models import Sound
     import numpy
 
-    sound = Mock({"numchan": 1})
-    sound.changed = Fake()
+    sound = Sound()
     sound.frames = numpy.array(range(1000), DTYPE)
 
     c = Graph(sound)
     c.set_width(200)
-    o = c.channels()
+    o = channels(c)
 
     class Foo:
         def foo(self):
@@ -225,68 +245,66 @@ def test_Graph():
     c = Graph(sound)
     c.changed.connect(f.foo)
     c.set_width(200)
-    o = c.channels()
+    o = channels(c)
 
     # stereo
     import numpy
-    sound = Mock({"numchan": 2})
-    sound.changed = Fake()
+    sound = Sound()
     data = numpy.array([[1, 1], [2, 2], [3, 3]], DTYPE)
     sound.frames = data
     c = Graph(sound)
-    o = c.channels()
+    o = channels(c)
     assert(len(o)) == 2
 
 
 def test_zoom():
-    from gum.lib.mock import Mock, Fake
+    from gum.models import Sound
     import numpy
 
-    sound = Mock({"numchan": 1})
+    sound = Sound()
     data = numpy.array([1, 2, 3, 4], DTYPE)
     sound.frames = data
-    sound.changed = Fake()
 
     g = Graph(sound)
 
     g.set_width(4)
     g._zoom(1)
     g.center_on(1.5)
-    o = g.channels()
+    o = channels(g)
     assert o == [[(1, 1), (2, 2), (3, 3), (4, 4)]]
 
     g._zoom(factor=1)
     g.center_on(0)
-    o = g.channels()
+    o = channels(g)
     assert o == [[(1, 1), (2, 2), (3, 3), (4, 4)]]
 
     g._zoom(1)
     g.center_on(6)
-    o = g.channels()
+    o = channels(g)
     assert o == [[(1, 1), (2, 2), (3, 3), (4, 4)]]
 
     g._zoom(factor=0.5)
     g.center_on(1.5)
     g.set_width(4)
-    o = g.channels()
+    o = channels(g)
     assert o == [[(1, 1), (2, 2), (3, 3), (4, 4)]]
 
     g.set_width(2)
     g._zoom(0.5)
     g.center_on(0)
-    o = g.channels()
+    o = channels(g)
     assert o == [[(1, 1), (2, 2)]]
 
     g.set_width(4)
     g._zoom(0.25)
     g.center_on(0)
-    o = g.channels()
+    o = channels(g)
     assert o == [[(1, 1), (2, 2), (3, 3), (4, 4)]]
 
     g.set_width(4)
     g._zoom(4)
     g.center_on(4)
-    o = g.channels()
+    o = channels(g)
     assert o == [[(1, 1), (2, 2), (3, 3), (4, 4)]], o
 
     g.set_width(100)
@@ -303,9 +321,8 @@ def test_zoom():
 
 def test_zoom_in():
     import numpy
-    from gum.lib.mock import Mock, Fake
-    sound = Mock({"numchan": 1})
-    sound.changed = Fake()
+    from gum.models import Sound
+    sound = Sound()
 
     data = numpy.array([1, 2, 3, 4], DTYPE)
     sound.frames = data
@@ -313,45 +330,44 @@ def test_zoom_in():
 
     g.set_width(2)
     g.zoom_in()
-    o = g.channels()
+    o = channels(g)
     assert o == [[(2, 2), (3, 3)]]
 
     g.zoom_out()
     g.set_width(4)
-    o = g.channels()
+    o = channels(g)
     assert o == [[(1, 1), (2, 2), (3, 3), (4, 4)]]
 
 
 def test_zoom_in_on():
     import numpy
-    from gum.lib.mock import Mock, Fake
-    sound = Mock({"numchan": 1})
-    sound.changed = Fake()
+    from gum.models import Sound
+    sound = Sound()
     data = numpy.array([1, 2, 3, 4], DTYPE)
     sound.frames = data
     g = Graph(sound)
     g.set_width(2)
 
+    # Cells overlap their neighbours by a quarter of a cell.
     g.zoom_in_on(0)
-    assert g.channels() == [[(1, 2), (3, 3)]]
+    assert channels(g) == [[(1, 2), (2, 4)]]
 
     g.zoom_out()
     g.zoom_in_on(1)
-    assert g.channels() == [[(1, 2), (3, 3)]]
+    assert channels(g) == [[(1, 2), (2, 4)]]
 
     g.zoom_out()
     g.zoom_in_on(2)
-    assert g.channels() == [[(1, 2), (3, 3)]]
+    assert channels(g) == [[(1, 2), (2, 4)]]
 
 
 def test_scroll():
     import numpy
-    from gum.lib.mock import Mock, Fake
+    from gum.models import Sound
 
-    sound = Mock({})
+    sound = Sound()
     data = numpy.array([1, 2, 3, 4])
     sound.frames = data
-    sound.changed = Fake()
 
     g = Graph(sound)
     g.set_width(4)
@@ -370,9 +386,9 @@ def test_density():
     g = Graph(Sound(gum.basedir + "/data/test/test1.wav"))
     g.set_width(700)
     g.zoom_in()
-    g.channels()
+    channels(g)
     g.zoom_in()
-    g.channels()
+    channels(g)
     g.zoom_in()
     d = g.density
 
@@ -387,15 +403,14 @@ def test_density():
 
 def test_channels():
     import numpy
-    from gum.lib.mock import Mock, Fake
-    sound = Mock({"numchan": 1})
-    sound.changed = Fake()
+    from gum.models import Sound
+    sound = Sound()
     sound.frames = numpy.array(range(1000000), DTYPE)
     g = Graph(sound)
 
     for w in [1, 10, 11, 12, 13, 14, 15, 29, 54, 12.0, 347, 231., 1030]:
         g.set_width(w)
-        c = g.channels()
+        c = channels(g)
         assert len(c[0]) == w, \
             "expected: %d, got: %d, density: %f, last value: %s " % \
             (w, len(c[0]), g.density, str(c[0][-1]))
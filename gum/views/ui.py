@@ -14,6 +14,7 @@ sys.argv[0] = constants.__appname__
 import gum
 from gum import app
 from gum.controllers import Editor, editor
+from gum.models import sound
 import timeline
 from filedialog import OpenFileDialog, SaveFileDialog, SaveSelectionFileDialog
 from lib import audiofile
@@ -27,10 +28,15 @@ gtk.gdk.threads_init()
 
 def init():
     """Called when the module is being imported."""
+    # Ready for the first file dialog.
+    audiofile.probe_extensions()
     notebook = EditorNotebook()
     win = EditorWindow(notebook)
     # Plug callbacks into app.
     app.new_sound_loaded.connect(win.on_new_sound_loaded)
+    # Sounds loaded in the background notify the views from the main
+    # loop.
+    sound.dispatch = gobject.idle_add
 
 
 def main_loop():
@@ -95,7 +101,8 @@ class EditorWindow(gtk.Window):
         self.handlers = {'space': self.toggle_play,
                          'ISO_Level3_Shift': self.play,
                          '<Shift>Home': self.select_till_start,
-                         '<Shift>End': self.select_till_end}
+                         '<Shift>End': self.select_till_end,
+                         'Escape': self.cancel_save}
 
         self.connect('key_press_event', self.on_key_press_event)
 
@@ -280,7 +287,7 @@ class EditorWindow(gtk.Window):
                     "goto_start", "goto_end", "select_all",
                     "cut", "copy", "paste", "mix", "undo", "redo",
                     "zoom_in", "zoom_out", "zoom_fit",
-                    "select_till_start", "select_till_end"]:
+                    "select_till_start", "select_till_end", "cancel_save"]:
             method = getattr(self.notebook, name)
 
             def forward(*args):
@@ -469,7 +476,7 @@ class EditorNotebook(gtk.Notebook):
                     "zoom_in", "zoom_out", "zoom_fit",
                     "select_till_start", "select_till_end",
                     "effect", "open", "save_as", "save_selection_as",
-                    "filename"]:
+                    "filename", "cancel_save"]:
             def forward(*args):
                 page = self.get_nth_page(self.get_current_page())
                 method = getattr(page, name)
@@ -525,11 +532,31 @@ class EditorPage(gtk.VBox):
         self.statusbar = gtk.Statusbar()
         self.pack_end(self.statusbar, expand=False, fill=False)
 
-        self.ctrl.filename_changed.connect(self._update_filename)
-        self.ctrl.error.connect(self.emit_error)
+        self._save_context = self.statusbar.get_context_id('save')
+        self.ctrl.filename_changed.connect(self._on_filename_changed)
+        self.ctrl.error.connect(self._on_error)
+        self.ctrl.save_progress.connect(self._on_save_progress)
         self.connect("destroy", self.on_destroy)
         self._update_filename()
 
+    # The controller signals may be emitted by a thread that saves the
+    # sound in the background: GTK calls are deferred to the main loop.
+
+    def _on_filename_changed(self):
+        gobject.idle_add(self._update_filename)
+
+    def _on_error(self, title, text):
+        gobject.idle_add(self.emit_error, title, text)
+
+    def _on_save_progress(self, fraction):
+        gobject.idle_add(self._show_save_progress, fraction)
+
+    def _show_save_progress(self, fraction):
+        self.statusbar.pop(self._save_context)
+        if fraction < 1:
+            text = "Saving: %d%% (Esc to cancel)" % int(fraction * 100)
+            self.statusbar.push(self._save_context, text)
+
     def must_close(self, *args):
         self.emit('must-close')
 
@@ -561,7 +588,7 @@ class EditorPage(gtk.VBox):
                     "zoom_in", "zoom_out", "zoom_fit",
                     "select_till_start", "select_till_end",
                     "effect", "open", "save_as", "save_selection_as",
-                    "filename", "on_selection_changed"]:
+                    "filename", "on_selection_changed", "cancel_save"]:
             method = getattr(self.ctrl, name)
 
             def forward(*args):
@@ -593,6 +620,7 @@ def test():
         def __init__(self):
             self.filename_changed = Fake()
             self.error = Fake()
+            self.save_progress = Fake()
 
     notebook = EditorNotebook()
     win = EditorWindow(notebook)
@@ -39,7 +39,7 @@ setup(name = 'gum-audio',
       ext_modules = [Extension('gum.fast', ['gum/fast/fast.c'],
                                libraries=['cairo']),
                      Extension('gum.fx._svf', ['gum/fx/_svf.c'])],
-      scripts = ['gum/scripts/gum'],
+      scripts = ['gum/scripts/gum', 'gum/scripts/gum-batch'],
       package_data = {
           'gum': ['data/*'],
       },